@@ -0,0 +1,295 @@
+"""scheduler hot path benchmarks against the in-memory datastore
+
+seeds locations x chargers x queued users per location for each size, then times each operation the way a
+request runs it and reports wall time, memory allocated and datastore operations as json
+
+    python benchmark.py --sizes 5:2:10 20:4:100 50:8:1000 --output bench_output.json
+
+--stress joins and leaves one location's queue from many threads at once and reports any lost updates
+
+    python benchmark.py --stress 32:200
+"""
+import os
+
+os.environ.setdefault('DATASTORE_BACKEND', 'memory')
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash
+
+from schedule import app
+import schedule.db.database as database
+import schedule.db.memory as memory
+from schedule.model.location import Charger
+from schedule.model.user import User
+
+default_sizes = ['5:2:10', '20:4:100', '50:8:1000']
+
+
+def seed(client: memory.Client, locations: int, chargers: int, users: int) -> dict:
+    """write the dataset directly in batches, creating entities one by one would hash every password"""
+    password = generate_password_hash('password')
+    now = datetime.utcnow()
+    tokens = {}
+
+    batch = client.batch()
+
+    def user_info(username: str, state: User.State, score: float) -> dict:
+        tokens[username] = f'token-{username}'
+        return {
+            'username': username,
+            'password': password,
+            'type': User.Type.user.name,
+            'score': score,
+            'state': state.name,
+            'score_last_updated': now,
+            'access_token': tokens[username],
+            'access_token_last_refreshed': now,
+            'notification_token': None
+        }
+
+    # not queued anywhere, for joining a queue
+    batch.set(client.collection(u'user').document(), user_info('user-idle', User.State.inactive, 500.0))
+
+    def flush():
+        nonlocal batch
+        if len(batch) >= 400:
+            batch.commit()
+            batch = client.batch()
+
+    for location_index in range(locations):
+        location_id = f'location-{location_index}'
+        location_ref = client.collection(u'location').document()
+
+        queue = []
+        for user_index in range(users):
+            user_ref = client.collection(u'user').document()
+            batch.set(user_ref, user_info(f'user-{location_index}-{user_index}', User.State.in_queue,
+                                          500.0 + user_index % 7))
+            queue.append(user_ref)
+            flush()
+
+        for charger_index in range(chargers):
+            batch.set(location_ref.collection(u'charger').document(), {
+                'location_id': location_id,
+                'charger_id': f'charger-{charger_index}',
+                'active_session': None,
+                'active_session_ref': None,
+                'last_session_id': 0,
+                'state': Charger.State.available.name
+            })
+            flush()
+
+        batch.set(location_ref, {
+            'location_id': location_id,
+            'queue': queue,
+            'reset_queue_daily': True,
+            'charger_count': chargers,
+            'free_chargers': chargers,
+            'queue_length': len(queue)
+        })
+        flush()
+
+    batch.commit()
+    return tokens
+
+
+def operations(tokens: dict):
+    """(name, callable) pairs run in order, later operations rely on state left by earlier ones"""
+
+    def access_token(token):
+        def run():
+            with app.test_request_context(headers={'Authorization': f'Bearer {token}'}):
+                from schedule.blueprint.decorators import get_token_user
+                return get_token_user()
+        return run
+
+    def tick_queue():
+        database.get_location('location-0').tick_queue()
+
+    def end_session():
+        database.end_session('location-0', 'charger-0')
+
+    def start_session():
+        location = database.get_location('location-1')
+        database.start_session('location-1', 'charger-0', location.candidates(1)[0])
+
+    def queue_user():
+        database.queue_user('location-0', database.get_user('user-idle'))
+
+    return [
+        ('access_token_cold', access_token(tokens['user-0-0'])),
+        ('access_token_warm', access_token(tokens['user-0-0'])),
+        ('get_locations', database.get_locations),
+        ('get_location_summaries', database.get_location_summaries),
+        ('tick_queue', tick_queue),
+        ('end_session', end_session),
+        ('start_session', start_session),
+        ('queue_user', queue_user),
+        ('reset_queues', database.reset_queues)
+    ]
+
+
+def run(size: str, trace_memory: bool) -> dict:
+    locations, chargers, users = [int(i) for i in size.split(':')]
+    if locations < 2 or chargers < 1 or users < 1:
+        raise ValueError(f'{size} needs at least 2 locations, 1 charger and 1 user')
+
+    client = memory.Client()
+    database.use_client(client)
+    tokens = seed(client, locations, chargers, users)
+
+    results = {}
+    for name, operation in operations(tokens):
+        client.reset_stats()
+
+        if trace_memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        with database.unit_of_work():
+            operation()
+        elapsed = time.perf_counter() - start
+
+        if trace_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[name] = {'peak_allocated_bytes': peak}
+        else:
+            results[name] = {'seconds': elapsed, **client.reset_stats()}
+
+    return results
+
+
+# run in a fresh interpreter, a cold start imports the app then creates its clients on the first request
+cold_start_script = '''
+import json, time
+start = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - start
+import schedule.clients as clients
+print(json.dumps({'import_seconds': import_seconds, 'clients': clients.warm_up(['datastore'])}))
+'''
+
+
+def cold_start() -> dict:
+    output = subprocess.check_output([sys.executable, '-c', cold_start_script],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)), env=dict(os.environ))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def stress(threads: int, users: int) -> dict:
+    """users join a charger-less location's queue from threads workers, then every other one leaves"""
+    client = memory.Client()
+    database.use_client(client)
+    seed(client, 0, 0, 0)
+
+    password = generate_password_hash('password')
+    batch = client.batch()
+    for i in range(users):
+        batch.set(client.collection(u'user').document(), {
+            'username': f'stress-{i}', 'password': password, 'type': User.Type.user.name, 'score': 500.0,
+            'state': User.State.inactive.name, 'score_last_updated': datetime.utcnow(), 'access_token': None,
+            'access_token_last_refreshed': None, 'notification_token': None
+        })
+    batch.commit()
+    database.create_location('stress')
+
+    def join(index):
+        with database.unit_of_work():
+            database.queue_user('stress', database.get_user(f'stress-{index}'))
+
+    def leave(index):
+        with database.unit_of_work():
+            database.remove_user_from_queue('stress', database.get_user(f'stress-{index}'))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(join, range(users)))
+        list(executor.map(leave, range(0, users, 2)))
+    elapsed = time.perf_counter() - start
+
+    location = [i.to_dict() for i in client.collection(u'location').where(u'location_id', u'==', 'stress').stream()][0]
+    queued = {i.get().to_dict()['username'] for i in location['queue']}
+    expected = {f'stress-{i}' for i in range(1, users, 2)}
+
+    return {
+        'threads': threads,
+        'users': users,
+        'seconds': elapsed,
+        'queue_length': location['queue_length'],
+        'lost_joins': len(expected - queued),
+        'lost_leaves': len(queued - expected),
+        'consistent': queued == expected and location['queue_length'] == len(expected)
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scheduler hot path benchmarks')
+    parser.add_argument('--sizes', nargs='+', default=default_sizes,
+                        help='locations:chargers:users per location, default %(default)s')
+    parser.add_argument('--stress', metavar='THREADS:USERS',
+                        help='run the concurrent queue stress check instead of the benchmarks')
+    parser.add_argument('--output', help='write json here instead of stdout')
+    args = parser.parse_args()
+
+    logging.getLogger('schedule').setLevel(logging.CRITICAL)
+
+    if args.stress:
+        result = stress(*[int(i) for i in args.stress.split(':')])
+        print(json.dumps(result, indent=2))
+        if not result['consistent']:
+            raise SystemExit(1)
+        return
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'timestamp': datetime.utcnow().isoformat(),
+        'cold_start': cold_start(),
+        'results': []
+    }
+
+    for size in args.sizes:
+        timings = run(size, trace_memory=False)
+        # allocations are traced on a separate identical run so tracing overhead stays out of the timings
+        allocations = run(size, trace_memory=True)
+
+        locations, chargers, users = [int(i) for i in size.split(':')]
+        for name in timings:
+            report['results'].append({
+                'operation': name,
+                'locations': locations,
+                'chargers': chargers,
+                'users': users,
+                **timings[name],
+                **allocations[name]
+            })
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from schedule import app
 from schedule.util.auth_token_refresh import refresh_access_tokens
+from schedule.util.rebuild_location_summary import rebuild_location_summary
 from schedule.util.reset_queue import reset_queue
 
 app = app
@@ -13,5 +14,9 @@ def lambda_reset_queue(event, context):
     return reset_queue(event, context)
 
 
+def lambda_rebuild_location_summary(event, context):
+    return rebuild_location_summary(event, context)
+
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
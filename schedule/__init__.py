@@ -1,19 +1,22 @@
-from .scheduler import app
-
 import logging
 import os
+import time
+
+import_start = time.perf_counter()
+
+from .scheduler import app
+import schedule.clients as clients
+import schedule.metrics as metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel('DEBUG')
 
 if os.environ.get('DEPLOY_DESTINATION', None) == 'PROD':
-    from google.cloud import logging as glogging
-
     log_format = '%(funcName)s - %(message)s'
     formatter = logging.Formatter(log_format)
 
-    client = glogging.Client()
-    handler = client.get_default_handler()
+    # the cloud logging client is created with the first record rather than at import
+    handler = clients.LazyHandler(lambda: clients.logging_client().get_default_handler())
 
     handler.setFormatter(formatter)
 
@@ -27,3 +30,7 @@ else:
     stream_handler.setFormatter(formatter)
 
     logger.addHandler(stream_handler)
+
+import_seconds = time.perf_counter() - import_start
+metrics.app_import_seconds.inc(amount=import_seconds)
+logger.debug(f'app imported in {import_seconds:.3f}s')
@@ -1,3 +1,4 @@
 from schedule.blueprint.auth_blueprint import blueprint as auth_blueprint
 from schedule.blueprint.location_blueprint import blueprint as location_blueprint
+from schedule.blueprint.metrics_blueprint import blueprint as metrics_blueprint
 from schedule.blueprint.user_blueprint import blueprint as user_blueprint
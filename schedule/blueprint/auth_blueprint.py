@@ -2,13 +2,11 @@ from flask import Blueprint, jsonify, request
 
 import logging
 
-from google.cloud import firestore
 
 import schedule.db.database as database
 from schedule.blueprint.decorators import access_token
 
 blueprint = Blueprint('bp_auth', __name__)
-db = firestore.Client()
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +55,7 @@ def login():
 @blueprint.route('/logout', methods=['GET'])
 @access_token
 def logout(current_user=None):
+    database.invalidate_access_token(current_user.access_token)
     current_user.access_token = None
     return jsonify({
         'message': 'user logged out',
@@ -0,0 +1,57 @@
+"""bulk provisioning request bodies
+
+a json array, or newline delimited json sent as application/x-ndjson, with one entity per element or line
+"""
+import json
+from typing import List
+
+from flask import jsonify, request
+
+ndjson_mimetypes = ['application/x-ndjson', 'application/ndjson', 'application/jsonl']
+
+# entities accepted in one request
+max_items = 5000
+
+# every user needs a deliberately slow password hash, at the default cost on two hashing workers a hundred
+# take several seconds, well inside the request deadline
+max_users = 100
+
+
+def is_bulk() -> bool:
+    return request.mimetype in ndjson_mimetypes or isinstance(request.get_json(silent=True), list)
+
+
+def parse_items(limit: int = max_items) -> List:
+    """raises ValueError when the body is not a json array or ndjson, or holds more than limit entities"""
+    if request.mimetype in ndjson_mimetypes:
+        items = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except json.JSONDecodeError:
+                    raise ValueError(f'malformed json on line {number}')
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise ValueError('expected a json array or ndjson')
+
+    if len(items) > limit:
+        raise ValueError(f'more than {limit} entities')
+
+    return items
+
+
+def item_ids(items: List, key: str) -> List:
+    """ids given either bare or as the key of an object"""
+    return [i.get(key) if isinstance(i, dict) else i for i in items]
+
+
+def bulk_response(results: List[dict], kind: str):
+    """200 when every entity was created, otherwise 207 with the outcome of each"""
+    created = sum(1 for i in results if i['status'] == 'ok')
+    return jsonify({
+        'message': f'{created} of {len(results)} {kind} created',
+        'results': results,
+        'status': 'ok' if created == len(results) else 'error'
+    }), 200 if created == len(results) else 207
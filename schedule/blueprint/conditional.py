@@ -0,0 +1,55 @@
+"""conditional GET from document versions
+
+location, charger and session documents carry a version counter moved by every update to them or to a
+document nested under them, so a request can be answered 304 from one document read, plus the users a
+location embeds in its queue
+"""
+import hashlib
+from datetime import datetime
+from typing import Optional, Tuple
+
+from flask import Response, request
+from werkzeug.http import http_date, is_resource_modified, quote_etag
+
+from schedule.db.timestamps import to_datetime
+
+
+def snapshot_version(snapshot, embedded: list = None) -> Tuple[str, Optional[datetime]]:
+    """etag and last modified time of a document snapshot and of the snapshots embedded in its response
+
+    the creation time keeps a deleted and recreated document from reusing old etags, embedded documents such
+    as users carry no version counter so their update times are folded into the etag instead
+    """
+    created = to_datetime(snapshot.create_time)
+    created = int(created.timestamp() * 1e6) if created is not None else 0
+
+    etag = f'{created:x}-{snapshot.to_dict().get("version", 0)}'
+    last_modified = to_datetime(snapshot.update_time)
+
+    if embedded:
+        update_times = sorted((i.reference.path, to_datetime(i.update_time)) for i in embedded)
+        digest = hashlib.blake2b(','.join(f'{i}@{j.timestamp() if j is not None else 0}' for i, j in update_times)
+                                 .encode(), digest_size=6).hexdigest()
+        etag = f'{etag}-{digest}'
+        last_modified = max([i for _, i in update_times if i is not None] +
+                            ([last_modified] if last_modified is not None else []), default=None)
+
+    return etag, last_modified
+
+
+def not_modified(etag: str, last_modified: datetime = None) -> bool:
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def version_headers(etag: str, last_modified: datetime = None) -> dict:
+    headers = {
+        'ETag': quote_etag(etag),
+        'Cache-Control': 'no-cache'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    return headers
+
+
+def not_modified_response(etag: str, last_modified: datetime = None) -> Response:
+    return Response(status=304, headers=version_headers(etag, last_modified))
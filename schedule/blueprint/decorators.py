@@ -1,9 +1,10 @@
 import functools
 import logging
 
-from flask import request, jsonify
+from flask import request, jsonify, g
 
 import schedule.db.database as database
+import schedule.db.accounting as accounting
 from schedule.model.user import User
 
 
@@ -40,7 +41,7 @@ def get_basic_auth_user():
     if request.authorization:
         if request.authorization.get('username', None) and request.authorization.get('password', None):
             basic_auth_user = database.get_user(request.authorization.username)
-            if basic_auth_user.check_password(request.authorization.password):
+            if basic_auth_user is not None and basic_auth_user.check_password(request.authorization.password):
                 return basic_auth_user
 
     return None
@@ -50,8 +51,8 @@ def get_token_user():
     header = request.headers.get('Authorization')
     if header is not None:
         if header.startswith('Bearer '):
-            token = header.lstrip('Bearer ')
-            return next((i for i in database.get_users() if i.access_token == token), None)
+            token = header[len('Bearer '):]
+            return database.get_user_by_access_token(token)
 
     return None
 
@@ -114,3 +115,20 @@ def url_arg_username_override(func):
         return func(*args, **kwargs)
 
     return url_arg_username_override_wrapper
+
+
+def operation_budget(**budget):
+    """most datastore operations a view may use, keys from accounting.operations, checked after commit"""
+    for operation in budget:
+        if operation not in accounting.operations:
+            raise ValueError(f'unknown datastore operation {operation}')
+
+    def operation_budget_decorator(func):
+        @functools.wraps(func)
+        def operation_budget_wrapper(*args, **kwargs):
+            g.operation_budget = budget
+            return func(*args, **kwargs)
+
+        return operation_budget_wrapper
+
+    return operation_budget_decorator
@@ -1,23 +1,64 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 
-from schedule.blueprint.decorators import admin_required, access_token, url_arg_username_override
+from schedule.blueprint.decorators import admin_required, access_token, url_arg_username_override, operation_budget
+from schedule.blueprint.bulk import bulk_response, item_ids, parse_items
+from schedule.blueprint.conditional import snapshot_version, not_modified, not_modified_response, version_headers
 import schedule.db.database as database
+import schedule.events as events
 from schedule.model.location import Charger
 from schedule.model.user import User
 
 import logging
+import os
+import time
+from datetime import datetime
 
-from google.cloud import firestore
 
 blueprint = Blueprint('bp_location', __name__)
-db = firestore.Client()
 
 logger = logging.getLogger(__name__)
 
+session_page_size = 20
+max_session_page_size = 100
+
+# app engine standard buffers whole responses, so unless EVENT_STREAMING=1 marks a deployment that can stream
+# (flexible environment, or cloud run with threaded workers) event requests long-poll, answering as soon as
+# events arrive. either way responses close before the platform request deadline and clients reconnect,
+# resuming with Last-Event-ID
+event_streaming = os.environ.get('EVENT_STREAMING') == '1'
+event_stream_seconds = float(os.environ.get('EVENT_STREAM_SECONDS', 50 if event_streaming else 25))
+event_heartbeat_seconds = 15
+event_retry_milliseconds = 1000
+
 
 @blueprint.route('', methods=['GET'])
+@operation_budget(round_trips=4)
 @access_token
 def locations(current_user: User = None):
+    view = request.args.get('view', 'full')
+    fields = request.args.get('fields')
+
+    if fields is not None:
+        fields = [i.strip() for i in fields.split(',') if len(i.strip()) > 0]
+        unknown = [i for i in fields if i not in database.summary_fields]
+        if len(fields) == 0 or len(unknown) > 0:
+            return jsonify({
+                'message': f'fields must be from {", ".join(database.summary_fields)}',
+                'status': 'error'
+            }), 400
+        view = 'summary'
+
+    if view == 'summary':
+        return jsonify({
+            'locations': database.get_location_summaries(fields),
+            'status': 'ok'
+        }), 200
+    elif view != 'full':
+        return jsonify({
+            'message': 'view must be full or summary',
+            'status': 'error'
+        }), 400
+
     pulled = database.get_locations()
 
     if locations is not None:
@@ -31,7 +72,26 @@ def locations(current_user: User = None):
     }), 503
 
 
+@blueprint.route('', methods=['POST'])
+@access_token
+@admin_required
+def locations_restricted(current_user: User = None):
+    logger.info(f'creating locations for {current_user}')
+
+    try:
+        location_ids = item_ids(parse_items(), 'location_id')
+    except ValueError as e:
+        logger.error(f'unable to read locations, {e}')
+        return jsonify({
+            'message': str(e),
+            'status': 'error'
+        }), 400
+
+    return bulk_response(database.create_locations(location_ids), 'locations')
+
+
 @blueprint.route('/<location_id>', methods=['GET'])
+@operation_budget(round_trips=4)
 @access_token
 def location(location_id, current_user: User = None):
     if request.method == 'GET':
@@ -53,13 +113,21 @@ def location_restricted(location_id, current_user: User = None):
 def get_location(location_id, current_user):
     logger.info(f'getting {location_id} for {current_user}')
 
-    location_obj = database.get_location(location_id)
+    location_snapshot = database.get_location_snapshot(location_id)
 
-    if location_obj is not None:
+    if location_snapshot is not None:
+        # queued users are embedded with their state and type, which do not move the location's version
+        user_snapshots = database.get_user_snapshots(location_snapshot.to_dict().get('queue', []))
+        version = snapshot_version(location_snapshot, user_snapshots)
+        if not_modified(*version):
+            return not_modified_response(*version)
+
+        users = {i.reference.path: database.parse_user(user_snapshot=i) for i in user_snapshots}
+        location_obj = database.parse_location(location_snapshot=location_snapshot, users=users)
         return jsonify({
             'location': location_obj.to_dict(),
             'status': 'ok'
-        }), 200
+        }), 200, version_headers(*version)
     else:
         logger.error(f'location {location_id} not found')
         return jsonify({
@@ -137,14 +205,21 @@ def delete_location(location_id, current_user):
 
 
 @blueprint.route('/<location_id>/charger', methods=['GET'])
+@operation_budget(round_trips=4)
 @access_token
 def chargers(location_id, current_user: User = None):
-    location_obj = database.get_location(location_id)
-    if location_obj is not None:
+    location_snapshot = database.get_location_snapshot(location_id)
+    if location_snapshot is not None:
+        # charger updates move their location's version
+        version = snapshot_version(location_snapshot)
+        if not_modified(*version):
+            return not_modified_response(*version)
+
+        location_obj = database.parse_location(location_snapshot=location_snapshot)
         return jsonify({
             'chargers': [i.to_dict() for i in location_obj.chargers],
             'status': 'ok'
-        }), 200
+        }), 200, version_headers(*version)
     else:
         return jsonify({
             'message': f'location {location_id} not found',
@@ -152,7 +227,33 @@ def chargers(location_id, current_user: User = None):
         }), 404
 
 
+@blueprint.route('/<location_id>/charger', methods=['POST'])
+@access_token
+@admin_required
+def chargers_restricted(location_id, current_user: User = None):
+    logger.info(f'creating {location_id} chargers for {current_user}')
+
+    try:
+        charger_ids = item_ids(parse_items(), 'charger_id')
+    except ValueError as e:
+        logger.error(f'unable to read chargers for {location_id}, {e}')
+        return jsonify({
+            'message': str(e),
+            'status': 'error'
+        }), 400
+
+    results = database.create_chargers(location_id, charger_ids)
+    if results is None:
+        return jsonify({
+            'message': f'location {location_id} not found',
+            'status': 'error'
+        }), 404
+
+    return bulk_response(results, 'chargers')
+
+
 @blueprint.route('/<location_id>/charger/<charger_id>', methods=['GET'])
+@operation_budget(round_trips=4)
 @access_token
 def charger(location_id, charger_id, current_user: User = None):
     if request.method == 'GET':
@@ -174,13 +275,18 @@ def charger_restricted(location_id, charger_id, current_user: User = None):
 def get_charger(location_id, charger_id, current_user):
     logger.info(f'getting {location_id}:{charger_id} for {current_user}')
 
-    charger_obj = database.get_charger(location_id, charger_id)
+    charger_snapshot = database.get_charger_snapshot(location_id, charger_id)
 
-    if charger_obj is not None:
+    if charger_snapshot is not None:
+        version = snapshot_version(charger_snapshot)
+        if not_modified(*version):
+            return not_modified_response(*version)
+
+        charger_obj = database.parse_charger(charger_snapshot=charger_snapshot)
         return jsonify({
             'charger': charger_obj.to_dict(),
             'status': 'ok'
-        }), 200
+        }), 200, version_headers(*version)
     else:
         logger.error(f'charger {location_id}:{charger_id} not found')
         return jsonify({
@@ -317,13 +423,23 @@ def session_restricted(location_id, charger_id, current_user: User = None):
 def get_session(location_id, charger_id, current_user):
     logger.info(f'getting {location_id}:{charger_id} session for {current_user}')
 
-    session_obj = database.get_active_session(location_id, charger_id)
+    # session updates and a change of active session both move the charger's version
+    charger_snapshot = database.get_charger_snapshot(location_id, charger_id)
+    if charger_snapshot is not None and charger_snapshot.to_dict().get('active_session') is not None:
+        version = snapshot_version(charger_snapshot)
+        if not_modified(*version):
+            return not_modified_response(*version)
+    else:
+        version = None
+
+    session_obj = database.get_active_session(location_id, charger_id, charger_snapshot=charger_snapshot) \
+        if charger_snapshot is not None else None
 
     if session_obj is not None:
         return jsonify({
             'session': session_obj.to_dict(),
             'status': 'ok'
-        }), 200
+        }), 200, version_headers(*version) if version is not None else {}
     else:
         logger.error(f'no active session at {location_id}:{charger_id}')
         return jsonify({
@@ -415,6 +531,102 @@ def delete_session(location_id, charger_id, current_user):
         }), 404
 
 
+@blueprint.route('/<location_id>/events', methods=['GET'])
+@operation_budget(round_trips=2)
+@access_token
+def location_events(location_id, current_user: User = None):
+    if database.get_location_snapshot(location_id) is None:
+        return jsonify({
+            'message': f'location {location_id} not found',
+            'status': 'error'
+        }), 404
+
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+
+    logger.info(f'{"streaming" if event_streaming else "polling"} {location_id} events for {current_user}')
+
+    def stream():
+        # subscribed here so a response that is never iterated leaves no subscription behind
+        with events.hub.subscribe(location_id, last_event_id) as subscription:
+            yield f'retry: {event_retry_milliseconds}\n\n'
+            for event in subscription.replay:
+                yield event.to_sse()
+            delivered = len(subscription.replay) > 0
+
+            deadline = time.monotonic() + event_stream_seconds
+            while not subscription.dropped and (event_streaming or not delivered):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                if not event_streaming:
+                    event = subscription.get(timeout=remaining)
+                    while event is not None:
+                        yield event.to_sse()
+                        delivered = True
+                        # pass on whatever else is already waiting, then close for the client to reconnect
+                        event = subscription.get(timeout=0)
+                    continue
+
+                event = subscription.get(timeout=min(event_heartbeat_seconds, remaining))
+                yield event.to_sse() if event is not None else ': heartbeat\n\n'
+                delivered = delivered or event is not None
+
+            if not delivered:
+                # nothing sent, reconnecting from here still replays anything published in between
+                yield f'id: {subscription.cursor}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache',
+                                                                     'X-Accel-Buffering': 'no'})
+
+
+@blueprint.route('/<location_id>/charger/<charger_id>/sessions', methods=['GET'])
+@operation_budget(round_trips=5)
+@access_token
+def sessions(location_id, charger_id, current_user: User = None):
+    logger.info(f'getting {location_id}:{charger_id} sessions for {current_user}')
+
+    try:
+        limit = min(max(int(request.args.get('limit', session_page_size)), 1), max_session_page_size)
+        start_after = int(request.args['start_after']) if 'start_after' in request.args else None
+        start_time_from = datetime.fromisoformat(request.args['from']) if 'from' in request.args else None
+        start_time_to = datetime.fromisoformat(request.args['to']) if 'to' in request.args else None
+    except ValueError:
+        logger.error(f'malformed session page arguments {dict(request.args)}')
+        return jsonify({
+            'message': 'limit and start_after must be integers, from and to ISO 8601 datetimes',
+            'status': 'error'
+        }), 400
+
+    expand_user = request.args.get('expand') == 'user'
+
+    try:
+        page, next_cursor = database.get_session_page(location_id, charger_id,
+                                                      limit=limit,
+                                                      start_after=start_after,
+                                                      start_time_from=start_time_from,
+                                                      start_time_to=start_time_to,
+                                                      expand_user=expand_user)
+        return jsonify({
+            'sessions': [i.to_dict(expand_user=expand_user) for i in page],
+            'next': next_cursor,
+            'status': 'ok'
+        }), 200
+
+    except FileNotFoundError:
+        logger.error(f'charger {location_id}:{charger_id} not found')
+        return jsonify({
+            'message': f'charger {location_id}:{charger_id} not found',
+            'status': 'error'
+        }), 404
+    except KeyError:
+        logger.error(f'session {location_id}:{charger_id}:{start_after} not found')
+        return jsonify({
+            'message': f'session {location_id}:{charger_id}:{start_after} not found',
+            'status': 'error'
+        }), 400
+
+
 @blueprint.route('/<location_id>/queue', methods=['POST', 'DELETE'])
 @access_token
 @url_arg_username_override
@@ -0,0 +1,17 @@
+from flask import Blueprint, Response
+
+import logging
+
+from schedule.blueprint.decorators import access_token, admin_required
+import schedule.metrics as metrics
+
+blueprint = Blueprint('bp_metrics', __name__)
+
+logger = logging.getLogger(__name__)
+
+
+@blueprint.route('', methods=['GET'])
+@access_token
+@admin_required
+def metrics_view(current_user=None):
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4'), 200
@@ -2,14 +2,13 @@ from flask import Blueprint, request, jsonify
 
 import logging
 
-from google.cloud import firestore
 
 import schedule.db.database as database
+from schedule.blueprint.bulk import bulk_response, is_bulk, max_users, parse_items
 from schedule.blueprint.decorators import admin_required, url_arg_username_override, access_token
 from schedule.model.user import User
 
 blueprint = Blueprint('bp_user', __name__)
-db = firestore.Client()
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +28,8 @@ def user(current_user: User = None):
 @admin_required
 def user_restricted(current_user: User = None):
     if request.method == 'POST':
+        if is_bulk():
+            return post_users(current_user)
         return post_user(current_user)
 
 
@@ -131,12 +132,33 @@ def post_user(current_user):
         }), 403
 
 
+def post_users(current_user):
+    logger.info(f'creating users for {current_user.username}')
+
+    try:
+        users = parse_items(max_users)
+    except ValueError as e:
+        logger.error(f'unable to read users for {current_user.username}, {e}')
+        return jsonify({
+            'message': str(e),
+            'status': 'error'
+        }), 400
+
+    if not all(isinstance(i, dict) for i in users):
+        return jsonify({
+            'message': 'users must be objects with a username and password',
+            'status': 'error'
+        }), 400
+
+    return bulk_response(database.create_users(users), 'users')
+
+
 def delete_user(current_user):
     logger.info(f'deleting {current_user.username}')
 
     if current_user is not None:
 
-        current_user.db_ref.delete()
+        database.delete_user(current_user.username)
 
         return jsonify({
             'message': f'{current_user.username} deleted',
@@ -0,0 +1,161 @@
+"""shared, lazily created service clients
+
+importing the app connects to nothing, each client is built on first use, timed, and reused after
+"""
+import logging
+import os
+import threading
+import time
+from typing import List
+
+import schedule.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+lock = threading.RLock()
+
+factories = {}  # client name -> function creating it
+instances = {}  # client name -> created client
+timings = {}  # client name -> seconds spent creating it
+
+
+def factory(name: str):
+    def register(func):
+        factories[name] = func
+        return func
+    return register
+
+
+def get(name: str):
+    instance = instances.get(name)
+    if instance is not None:
+        return instance
+
+    with lock:
+        if name not in instances:
+            if name not in factories:
+                raise KeyError(f'unknown client {name}')
+
+            start = time.perf_counter()
+            instances[name] = factories[name]()
+            timings[name] = time.perf_counter() - start
+
+            metrics.client_init_seconds.inc(name, amount=timings[name])
+            logger.info(f'created {name} client in {timings[name]:.3f}s')
+
+        return instances[name]
+
+
+def use(name: str, instance) -> None:
+    """replace a client, for benchmarks and alternative backends"""
+    with lock:
+        instances[name] = instance
+
+
+def initialized(name: str) -> bool:
+    return name in instances
+
+
+def discard(name: str):
+    """forget a client so the next use creates it again, returns the discarded client"""
+    with lock:
+        return instances.pop(name, None)
+
+
+@factory('datastore')
+def create_datastore():
+    """DATASTORE_BACKEND=memory swaps firestore for the in-process stand-in"""
+    backend = os.environ.get('DATASTORE_BACKEND', 'firestore')
+
+    if backend == 'memory':
+        import schedule.db.memory as memory
+        logger.info('using in-memory datastore')
+        return memory.Client()
+    elif backend == 'firestore':
+        from google.cloud import firestore
+        return firestore.Client()
+    else:
+        raise ValueError(f'unknown datastore backend {backend}')
+
+
+@factory('replica')
+def create_replica():
+    """listener backed location and charger replica, REPLICA_MAX_STALENESS bounds how long it may serve while
+    disconnected and REPLICA_MAX_LAG how far its listeners may trail the datastore"""
+    from schedule.db.replica import Replica
+    replica = Replica(datastore(), float(os.environ.get('REPLICA_MAX_STALENESS', 5)),
+                      float(os.environ.get('REPLICA_MAX_LAG', 2)))
+    replica.start()
+    return replica
+
+
+@factory('firebase')
+def create_firebase_app():
+    import firebase_admin
+    return firebase_admin.initialize_app()
+
+
+@factory('logging')
+def create_logging_client():
+    from google.cloud import logging as glogging
+    return glogging.Client()
+
+
+def datastore():
+    return get('datastore')
+
+
+def firebase_app():
+    return get('firebase')
+
+
+def replica():
+    return get('replica')
+
+
+def logging_client():
+    return get('logging')
+
+
+def warm_up(names: List[str] = None) -> dict:
+    """create clients ahead of the first request, WARMUP_CLIENTS lists them, default datastore"""
+    if names is None:
+        names = [i.strip() for i in os.environ.get('WARMUP_CLIENTS', 'datastore').split(',') if i.strip()]
+
+    for name in names:
+        get(name)
+
+    return {i: timings.get(i) for i in names}
+
+
+class LazyHandler(logging.Handler):
+    """defers building a log handler, and the client behind it, to the first record"""
+
+    def __init__(self, create_handler):
+        super().__init__()
+        self.create_handler = create_handler
+        self.handler = None
+        self.creating = False
+        self.pending = []  # records emitted while the handler was being created
+
+    def emit(self, record):
+        if self.handler is None:
+            with lock:
+                if self.creating:
+                    self.pending.append(record)
+                    return
+
+                if self.handler is None:
+                    self.creating = True
+                    try:
+                        handler = self.create_handler()
+                        handler.setFormatter(self.formatter)
+                        self.handler = handler
+                    finally:
+                        self.creating = False
+
+                pending, self.pending = self.pending, []
+            for i in pending:
+                self.handler.handle(i)
+
+        self.handler.handle(record)
@@ -0,0 +1,72 @@
+import functools
+import logging
+import threading
+
+import schedule.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+local = threading.local()
+
+operations = ['round_trips', 'reads', 'queries', 'streamed', 'writes']
+
+
+class OperationBudgetExceeded(AssertionError):
+    pass
+
+
+class OperationCounts:
+    """datastore work done on behalf of one request or job"""
+
+    def __init__(self):
+        self.counts = {i: 0 for i in operations}
+        self.calls = {}  # database function -> times called
+
+    def record(self, **counts):
+        for operation, count in counts.items():
+            self.counts[operation] += count
+
+    def to_dict(self) -> dict:
+        return dict(self.counts)
+
+    def over_budget(self, budget: dict) -> dict:
+        """operations over their budgeted maximum, operation -> (count, budget)"""
+        return {i: (self.counts[i], j) for i, j in budget.items() if self.counts[i] > j}
+
+    def __str__(self):
+        return ', '.join(f'{i}={j}' for i, j in self.counts.items())
+
+
+def current():
+    return getattr(local, 'counts', None)
+
+
+def begin() -> OperationCounts:
+    local.counts = OperationCounts()
+    return local.counts
+
+
+def end() -> OperationCounts:
+    counts = current()
+    local.counts = None
+    return counts
+
+
+def record(round_trips: int = 1, **counts):
+    operation_counts = current()
+    if operation_counts is not None:
+        operation_counts.record(round_trips=round_trips, **counts)
+
+
+def accounted(func):
+    """count calls to a database function against the active request and time them"""
+    @functools.wraps(func)
+    def accounted_wrapper(*args, **kwargs):
+        operation_counts = current()
+        if operation_counts is not None:
+            operation_counts.calls[func.__name__] = operation_counts.calls.get(func.__name__, 0) + 1
+
+        with metrics.datastore_latency.time(func.__name__):
+            return func(*args, **kwargs)
+
+    return accounted_wrapper
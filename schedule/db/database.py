@@ -1,36 +1,439 @@
 from google.cloud import firestore
+from cachetools import TTLCache
+import functools
 import logging
-import random, string
+import os
+import secrets
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional, List
 
+import schedule.clients as clients
+import schedule.db.unit_of_work as unit_of_work_registry
+import schedule.db.memory as memory
+import schedule.db.accounting as accounting
+from schedule.db.accounting import accounted
+
+# scoring first, it imports from the user module which in turn imports scoring
+import schedule.model.scoring as scoring
 from schedule.model.user import User
 from schedule.model.location import Location, Charger
 from schedule.model.session import Session
+import schedule.events as events
 
-from werkzeug.security import generate_password_hash
+import schedule.passwords as passwords
 
-db = firestore.Client()
 logger = logging.getLogger(__name__)
 
+# locations reset at the same time by reset_queues
+reset_workers = 8
+
+# users per page and write batches committed at once by rotate_access_tokens
+rotation_page_size = 1000
+rotation_workers = 4
+rotation_cursor_path = u'job/access_token_rotation'
+
+# LOCATION_REPLICA=1 serves read only requests' location and charger reads from a listener backed replica
+replica_enabled = os.environ.get('LOCATION_REPLICA') == '1'
+
+# maintained on each location document so listings need no charger or user reads
+summary_fields = ['location_id', 'charger_count', 'free_chargers', 'queue_length']
+
+
+def client():
+    """the shared datastore client, created on first use"""
+    return clients.datastore()
+
+
+def use_client(datastore_client) -> None:
+    clients.use('datastore', datastore_client)
+    with access_token_cache_lock:
+        access_token_cache.clear()
+
+    # the replica listens to the previous client
+    replica = clients.discard('replica')
+    if replica is not None:
+        replica.stop()
+
+
+def read_replica():
+    """the location replica when enabled, current enough and the active unit of work only reads"""
+    uow = current_unit_of_work()
+    if not replica_enabled or uow is None or not uow.read_only:
+        return None
+
+    replica = clients.replica()
+    return replica if replica.serving() else None
+
+
+def staged_writes(transaction) -> int:
+    """writes a transaction will send on commit, firestore counts field transforms as writes of their own"""
+    if isinstance(transaction, memory.Transaction):
+        return len(transaction)
+    return len(transaction._write_pbs)
+
+
+def transactional(func):
+    """run func(transaction, ...) with retries under whichever backend created the transaction
+
+    every attempt is accounted as its begin and commit round trips with the writes it staged, so retries
+    under contention show up in the request's counts
+    """
+    @functools.wraps(func)
+    def attempt(transaction, *args, **kwargs):
+        result = func(transaction, *args, **kwargs)
+        accounting.record(round_trips=2, writes=staged_writes(transaction))
+        return result
+
+    firestore_func = firestore.transactional(attempt)
+    memory_func = memory.transactional(attempt)
+
+    @functools.wraps(func)
+    def transactional_wrapper(transaction, *args, **kwargs):
+        if isinstance(transaction, memory.Transaction):
+            return memory_func(transaction, *args, **kwargs)
+        return firestore_func(transaction, *args, **kwargs)
+
+    return transactional_wrapper
+
 illegal_characters = [' ', ':', '/']
 
+# firestore accepts at most 10 values in an 'in' filter
+in_filter_limit = 10
+
+access_token_characters = string.ascii_letters + string.digits
+access_token_length = 30
+access_token_attempts = 5
+
+# access token -> user reference, turns the token query on every authenticated request into a point read
+access_token_cache = TTLCache(maxsize=4096, ttl=60)
+access_token_cache_lock = threading.Lock()
+
+
+def stream(query, transaction=None) -> list:
+    snapshots = [i for i in query.stream(transaction=transaction)]
+    accounting.record(queries=1, streamed=len(snapshots))
+    return snapshots
+
+
+def read(db_ref, transaction=None):
+    accounting.record(reads=1)
+    return db_ref.get(transaction=transaction)
+
+
+def read_all(db_refs: list, transaction=None) -> list:
+    snapshots = [i for i in client().get_all(db_refs, transaction=transaction)]
+    accounting.record(reads=len(db_refs))
+    return snapshots
+
+
+def write(db_ref, document_data: dict) -> None:
+    accounting.record(writes=1)
+    db_ref.set(document_data)
+
+
+def delete_document(db_ref) -> None:
+    accounting.record(writes=1)
+    db_ref.delete()
+
+
+def versioned_updates(db_ref, updates: dict) -> list:
+    """(document reference, field updates) pairs that also move the version of a location, charger or
+    session and of every resource embedding it, so a charger change retags its location"""
+    if not db_ref.path.startswith(u'location/'):
+        return [(db_ref, updates)]
+
+    pending = [(db_ref, dict(updates, version=firestore.Increment(1)))]
+
+    parent = db_ref.parent.parent
+    while parent is not None:
+        pending.append((parent, {'version': firestore.Increment(1)}))
+        parent = parent.parent.parent
 
+    return pending
+
+
+def update_documents(updates: list, executor: ThreadPoolExecutor = None) -> int:
+    """apply (document reference, field updates) pairs straight away in chunked write batches,
+    committed concurrently when given an executor"""
+    limit = unit_of_work_registry.batch_limit
+
+    refs, merged = {}, {}
+    for db_ref, fields in [j for i in updates for j in versioned_updates(*i)]:
+        refs[db_ref.path] = db_ref
+        unit_of_work_registry.merge_updates(merged.setdefault(db_ref.path, {}), fields)
+    updates = [(refs[i], j) for i, j in merged.items()]
+
+    def commit(chunk):
+        batch = client().batch()
+        for db_ref, fields in chunk:
+            batch.update(db_ref, fields)
+        batch.commit()
+        accounting.record(writes=len(chunk))
+
+    chunks = [updates[i:i + limit] for i in range(0, len(updates), limit)]
+    if executor is None:
+        for chunk in chunks:
+            commit(chunk)
+    else:
+        list(executor.map(commit, chunks))
+
+    return len(updates)
+
+
+def create_documents(documents: list) -> int:
+    """write (document reference, document data) pairs of new documents straight away in chunked write batches"""
+    limit = unit_of_work_registry.batch_limit
+
+    for index in range(0, len(documents), limit):
+        chunk = documents[index:index + limit]
+        batch = client().batch()
+        for db_ref, document_data in chunk:
+            batch.set(db_ref, document_data)
+        batch.commit()
+        accounting.record(writes=len(chunk))
+
+    return len(documents)
+
+
+def existing_values(query, field_path: str, values: list) -> set:
+    """which of values are already held in field_path, querying for just those values rather than reading
+    the whole collection"""
+    values = sorted({i for i in values if isinstance(i, str) and len(i) > 0})
+
+    existing = set()
+    for index in range(0, len(values), in_filter_limit):
+        chunk = values[index:index + in_filter_limit]
+        existing.update(i.get(field_path) for i in stream(query.where(field_path, u'in', chunk).select([field_path])))
+    return existing
+
+
+def screen_ids(ids: list, existing: set, kind: str, check_characters: bool = True) -> List[Optional[str]]:
+    """why each id cannot be created, None for those that can"""
+    seen = set()
+    errors = []
+    for entity_id in ids:
+        if not isinstance(entity_id, str) or len(entity_id) == 0:
+            error = f'no {kind} id provided'
+        elif check_characters and any(i in entity_id for i in illegal_characters):
+            error = f'illegal character present in {entity_id}'
+        elif entity_id in existing:
+            error = f'{kind} {entity_id} already registered'
+        elif entity_id in seen:
+            error = f'{kind} {entity_id} repeated'
+        else:
+            error = None
+            seen.add(entity_id)
+        errors.append(error)
+    return errors
+
+
+def bulk_results(key: str, ids: list, errors: List[Optional[str]], kind: str) -> List[dict]:
+    return [{key: i, 'status': 'ok', 'message': f'{kind} {i} created'} if j is None else
+            {key: i, 'status': 'error', 'message': j} for i, j in zip(ids, errors)]
+
+
+def current_unit_of_work() -> Optional[unit_of_work_registry.UnitOfWork]:
+    return unit_of_work_registry.current()
+
+
+def begin_unit_of_work(read_only: bool = False) -> unit_of_work_registry.UnitOfWork:
+    return unit_of_work_registry.begin(client(), read_only)
+
+
+def commit_unit_of_work() -> None:
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.commit()
+
+
+def rollback_unit_of_work() -> None:
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.rollback()
+
+
+def end_unit_of_work() -> None:
+    unit_of_work_registry.end()
+
+
+def pending_updates(db_refs: list) -> dict:
+    """field updates the active unit of work holds for the given documents, document path -> field updates"""
+    uow = current_unit_of_work()
+    return uow.pending([i.path for i in db_refs]) if uow is not None else {}
+
+
+def discard_updates(paths) -> None:
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.discard(list(paths))
+
+
+def overlay(document: dict, updates: dict) -> dict:
+    """a document as it will read once the plain field updates apply, transforms are left out"""
+    transforms = (firestore.Increment, firestore.ArrayUnion, firestore.ArrayRemove)
+    return {**document, **{i: j for i, j in updates.items() if not isinstance(j, transforms)}}
+
+
+def after_commit(callback) -> None:
+    """run callback once the active unit of work commits, never if it rolls back, or straight away without one"""
+    uow = current_unit_of_work()
+    if uow is not None:
+        uow.after_commit(callback)
+    else:
+        callback()
+
+
+@contextmanager
+def unit_of_work():
+    """load each document once and write merged updates in batches on exit, joins an active unit of work"""
+    if current_unit_of_work() is not None:
+        yield current_unit_of_work()
+        return
+
+    uow = begin_unit_of_work()
+    try:
+        yield uow
+        uow.commit()
+    finally:
+        end_unit_of_work()
+
+
+@accounted
+def update_document(db_ref, updates: dict) -> None:
+    uow = current_unit_of_work()
+    if uow is not None:
+        for i, j in versioned_updates(db_ref, updates):
+            uow.update(i, j)
+    else:
+        update_documents([(db_ref, updates)])
+
+
+def lookup_identity(kind: str, key):
+    uow = current_unit_of_work()
+    if uow is not None:
+        return uow.lookup(kind, key)
+
+
+def register_identity(db_ref, kind: str, key, model):
+    uow = current_unit_of_work()
+    if uow is not None:
+        existing = uow.get(db_ref.path)
+        if existing is not None:
+            return existing
+        uow.register(db_ref.path, kind, key, model)
+    return model
+
+
+def generate_access_token() -> str:
+    """a random 30 character token, the 62^30 token space makes a collision with an existing token
+    vanishingly rare"""
+    return ''.join(secrets.choice(access_token_characters) for _ in range(access_token_length))
+
+
+@accounted
 def get_new_access_token():
-    prospective_key = ''.join(random.choices(string.ascii_letters + string.digits, k=30))
-    if prospective_key not in [i.access_token for i in get_users()]:
-        return prospective_key
+    # a single indexed lookup per candidate from generate_access_token keeps the uniqueness guarantee
+    # without reading every user
+    for _ in range(access_token_attempts):
+        prospective_key = generate_access_token()
+        if len(stream(client().collection(u'user').where(u'access_token', u'==', prospective_key).limit(1))) == 0:
+            return prospective_key
+
+        logger.warning('access token collision, regenerating')
+
+    raise SystemError('unable to generate unique access token')
+
+
+@accounted
+def rotate_access_tokens(time_limit: float = None) -> dict:
+    """give every non service user a new access token, a page at a time in username order
+
+    progress is saved after each page so a run stopped by time_limit or a timeout resumes where it left off
+    """
+    start = time.perf_counter()
+    now = datetime.utcnow()
+
+    cursor_ref = client().document(rotation_cursor_path)
+    cursor = read(cursor_ref)
+    cursor = cursor.to_dict() if cursor.exists else {}
+
+    resumed = cursor.get('complete') is False
+    if not resumed:
+        cursor = {'started': now, 'last_username': None, 'rotated': 0, 'complete': False}
+        write(cursor_ref, cursor)
     else:
-        return get_new_access_token()
+        logger.info(f'resuming access token rotation after {cursor["last_username"]}')
+
+    # generated this run, generate_access_token makes a clash with an existing token vanishingly rare
+    generated = set()
+
+    pages = 0
+    with ThreadPoolExecutor(max_workers=rotation_workers) as executor:
+        while True:
+            if time_limit is not None and time.perf_counter() - start > time_limit:
+                logger.warning(f'access token rotation stopped after {cursor["last_username"]}, will resume')
+                break
+
+            query = client().collection(u'user').select([u'username', u'type', u'access_token']) \
+                .order_by(u'username').limit(rotation_page_size)
+            if cursor['last_username'] is not None:
+                query = query.start_after({u'username': cursor['last_username']})
+
+            users = stream(query)
+            if len(users) == 0:
+                cursor['complete'] = True
+                update_documents([(cursor_ref, {'complete': True, 'finished': datetime.utcnow()})])
+                break
+
+            updates = []
+            for user_snapshot in users:
+                if user_snapshot.get(u'type') == User.Type.service.name:
+                    continue
+
+                access_token = generate_access_token()
+                while access_token in generated:
+                    access_token = generate_access_token()
+                generated.add(access_token)
+
+                updates.append((user_snapshot.reference, {'access_token': access_token,
+                                                          'access_token_last_refreshed': now}))
+                invalidate_access_token(user_snapshot.get(u'access_token'))
+
+            update_documents(updates, executor)
+
+            pages += 1
+            cursor['last_username'] = users[-1].get(u'username')
+            cursor['rotated'] += len(updates)
+            update_documents([(cursor_ref, {'last_username': cursor['last_username'],
+                                            'rotated': cursor['rotated']})])
+
+    summary = {
+        'rotated': cursor['rotated'],
+        'pages': pages,
+        'resumed': resumed,
+        'complete': cursor['complete'],
+        'seconds': time.perf_counter() - start
+    }
+    logger.info(f'rotated {summary["rotated"]} access tokens over {pages} pages in {summary["seconds"]:.3f}s, '
+                f'{"complete" if summary["complete"] else "incomplete"}')
+
+    return summary
 
 
+@accounted
 def get_users():
     logger.debug('getting users')
 
-    users = [i for i in db.collection(u'user').stream()]
+    users = stream(client().collection(u'user'))
     return [parse_user(user_snapshot=i) for i in users]
 
 
+@accounted
 def get_user(username: str) -> Optional[User]:
     logger.debug(f'retrieving {username}')
 
@@ -39,7 +442,11 @@ def get_user(username: str) -> Optional[User]:
     else:
         return None
 
-    users = [i for i in db.collection(u'user').where(u'username', u'==', username).stream()]
+    user = lookup_identity('user', username)
+    if user is not None:
+        return user
+
+    users = stream(client().collection(u'user').where(u'username', u'==', username))
 
     if len(users) == 0:
         logger.error(f'user {username} not found')
@@ -51,6 +458,51 @@ def get_user(username: str) -> Optional[User]:
     return parse_user(user_snapshot=users[0])
 
 
+@accounted
+def get_user_by_access_token(access_token: str) -> Optional[User]:
+    if access_token is None:
+        return None
+
+    # only the reference is cached, the user is always read fresh so state, type and score are current
+    with access_token_cache_lock:
+        user_ref = access_token_cache.get(access_token)
+
+    if user_ref is not None:
+        uow = current_unit_of_work()
+        if uow is not None and uow.get(user_ref.path) is not None:
+            return uow.get(user_ref.path)
+
+        user_snapshot = read(user_ref)
+        if user_snapshot.exists and user_snapshot.to_dict().get('access_token') == access_token:
+            return parse_user(user_snapshot=user_snapshot)
+
+        # rotated, logged out or deleted elsewhere
+        invalidate_access_token(access_token)
+
+    users = stream(client().collection(u'user').where(u'access_token', u'==', access_token).limit(2))
+
+    if len(users) == 0:
+        logger.debug('no user found for access token')
+        return None
+    if len(users) > 1:
+        logger.critical('multiple users found for access token')
+        return None
+
+    with access_token_cache_lock:
+        access_token_cache[access_token] = users[0].reference
+
+    return parse_user(user_snapshot=users[0])
+
+
+def invalidate_access_token(access_token: str) -> None:
+    if access_token is None:
+        return
+
+    with access_token_cache_lock:
+        access_token_cache.pop(access_token, None)
+
+
+@accounted
 def parse_user(user_ref=None, user_snapshot=None) -> User:
     if user_ref is None and user_snapshot is None:
         raise ValueError('no user object supplied')
@@ -58,12 +510,16 @@ def parse_user(user_ref=None, user_snapshot=None) -> User:
     if user_ref is None:
         user_ref = user_snapshot.reference
 
+    uow = current_unit_of_work()
+    if uow is not None and uow.get(user_ref.path) is not None:
+        return uow.get(user_ref.path)
+
     if user_snapshot is None:
-        user_snapshot = user_ref.get()
+        user_snapshot = read(user_ref)
 
     user_dict = user_snapshot.to_dict()
 
-    return User(username=user_dict.get('username'),
+    user = User(username=user_dict.get('username'),
                 password=user_dict.get('password'),
                 db_ref=user_ref,
 
@@ -78,72 +534,202 @@ def parse_user(user_ref=None, user_snapshot=None) -> User:
 
                 notification_token=user_dict.get('notification_token'))
 
+    return register_identity(user_ref, 'user', user.username, user)
 
-def create_user(username: str,
-                password: str,
-                user_type: User.Type) -> None:
 
-    logger.debug(f'creating {username}')
+@accounted
+def get_user_snapshots(user_refs: list) -> list:
+    """snapshots of the users that still exist, in one batched read"""
+    if len(user_refs) == 0:
+        return []
+    return [i for i in read_all(user_refs) if i.exists]
 
-    username = username.lower()
 
-    user_collection = db.collection(u'user')
+def get_users_by_ref(user_refs) -> dict:
+    """fetch users for a collection of references in one batched read, keyed by document path"""
+    refs = {}
+    for user_ref in user_refs:
+        refs.setdefault(user_ref.path, user_ref)
 
-    # check if username is already registered
-    current_users = [i for i in user_collection.where(u'username', u'==', username).stream()]
-    if len(current_users) > 0:
-        logger.error(f'user {username} already exists')
-        raise FileExistsError('user already registered')
+    users = {}
+
+    uow = current_unit_of_work()
+    if uow is not None:
+        for path in [i for i in refs if uow.get(i) is not None]:
+            users[path] = uow.get(path)
+            del refs[path]
+
+    if len(refs) == 0:
+        return users
+
+    for user_snapshot in read_all(list(refs.values())):
+        if not user_snapshot.exists:
+            logger.error(f'user {user_snapshot.reference.path} not found')
+            continue
+        users[user_snapshot.reference.path] = parse_user(user_snapshot=user_snapshot)
+
+    return users
 
+
+def user_manifest(username: str, password_hash: str, user_type: User.Type, access_token: str) -> dict:
     # USER DATABASE ENTITY MANIFEST
-    user_info = {
+    return {
         'username': username,
-        'password': generate_password_hash(password),
+        'password': password_hash,
         'type': user_type.name,
         'score': 500,
         'state': User.State.inactive.name,
         'score_last_updated': datetime.utcnow(),
-        'access_token': get_new_access_token(),
+        'access_token': access_token,
         'access_token_last_refreshed': datetime.utcnow(),
         'notification_token': None
     }
 
-    user_collection.document().set(user_info)
 
+@accounted
+def create_user(username: str,
+                password: str,
+                user_type: User.Type) -> None:
 
-def update_user(username: str, updates: dict):
-    logger.debug(f'updating {username}, {", ".join([f"{i} = {j}" for i, j in updates.items()])}')
+    logger.debug(f'creating {username}')
 
-    user = get_user(username)
+    username = username.lower()
 
-    if user is not None:
-        user.db_ref.update(updates)
-    else:
-        logger.error('no user returned')
+    user_collection = client().collection(u'user')
+
+    # check if username is already registered
+    current_users = stream(user_collection.where(u'username', u'==', username))
+    if len(current_users) > 0:
+        logger.error(f'user {username} already exists')
+        raise FileExistsError('user already registered')
+
+    user_info = user_manifest(username, passwords.hash_password(password), user_type, get_new_access_token())
+
+    write(user_collection.document(), user_info)
+
+
+@accounted
+def create_users(users: List[dict]) -> List[dict]:
+    """register users given as username, password and optional type, checking only the submitted usernames
+    and writing in chunked batches, returns a result per user"""
+    logger.debug(f'creating {len(users)} users')
+
+    user_collection = client().collection(u'user')
+
+    usernames = [i.get('username').lower() if isinstance(i.get('username'), str) else None for i in users]
+    errors = screen_ids(usernames, existing_values(user_collection, u'username', usernames), 'username',
+                        check_characters=False)
+
+    for index, user_json in enumerate(users):
+        if errors[index] is not None:
+            continue
+        if not isinstance(user_json.get('password'), str) or len(user_json['password']) == 0:
+            errors[index] = 'no password provided'
+        elif user_json.get('type', 'user') not in User.Type.__members__:
+            errors[index] = f'unknown user type {user_json.get("type")}'
+
+    accepted = [i for i, j in enumerate(errors) if j is None]
+    password_hashes = passwords.hash_passwords([users[i]['password'] for i in accepted])
+
+    # tokens from generate_access_token almost never collide, so a batch skips the lookup per token
+    documents = []
+    for index, password_hash in zip(accepted, password_hashes):
+        user_type = User.Type[users[index].get('type', 'user')]
+        documents.append((user_collection.document(),
+                          user_manifest(usernames[index], password_hash, user_type, generate_access_token())))
 
+    create_documents(documents)
 
+    return bulk_results('username', usernames, errors, 'user')
+
+
+@accounted
 def delete_user(username: str) -> None:
     logger.debug(f'deleting {username}')
 
     user = get_user(username)
 
     if user is not None:
-        user.db_ref.delete()
+        invalidate_access_token(user.access_token)
+        if current_unit_of_work() is not None:
+            current_unit_of_work().evict(user.db_ref.path)
+        delete_document(user.db_ref)
     else:
         logger.error('no user returned')
 
 
+@accounted
 def get_locations() -> Optional[List[Location]]:
     logger.debug('retrieving all locations')
 
-    locations = [i for i in db.collection(u'location').stream()]
-    return [parse_location(location_snapshot=i) for i in locations]
+    replica = read_replica()
+    if replica is not None:
+        locations = replica.all_locations()
+        chargers = {i.reference.path: replica.location_chargers(i.reference.path) for i in locations}
+    else:
+        locations = stream(client().collection(u'location'))
+
+        # hydrate every location's children with one query for chargers and one batched read for users
+        chargers = {}
+        for charger_snapshot in stream(client().collection_group(u'charger')):
+            chargers.setdefault(charger_snapshot.reference.parent.parent.path, []).append(charger_snapshot)
+
+    users = get_users_by_ref([j for i in locations for j in i.to_dict().get('queue', [])])
 
+    return [parse_location(location_snapshot=i,
+                           charger_snapshots=chargers.get(i.reference.path, []),
+                           users=users) for i in locations]
+
+
+@accounted
+def get_location_summaries(fields: List[str] = None) -> List[dict]:
+    """the maintained summary of every location with one projected query"""
+    fields = fields or summary_fields
+    logger.debug(f'retrieving location summaries, {", ".join(fields)}')
+
+    replica = read_replica()
+    if replica is not None:
+        locations = replica.all_locations()
+    else:
+        locations = stream(client().collection(u'location').select(fields))
 
+    return [{i: location.to_dict().get(i) for i in fields} for location in locations]
+
+
+@accounted
+def rebuild_location_summaries() -> int:
+    """recount every location's summary from its chargers and queue, for documents written before it existed"""
+    updates = [(i.db_ref, {'charger_count': len(i.chargers),
+                           'free_chargers': len([j for j in i.chargers if j.active_session is None]),
+                           'queue_length': len(i.queue)}) for i in get_locations()]
+    return update_documents(updates)
+
+
+@accounted
 def get_location(location_id: str) -> Optional[Location]:
     logger.debug(f'retrieving {location_id}')
 
-    locations = [i for i in db.collection(u'location').where(u'location_id', u'==', location_id).stream()]
+    location = lookup_identity('location', location_id)
+    if location is not None:
+        return location
+
+    location_snapshot = get_location_snapshot(location_id)
+    if location_snapshot is None:
+        return None
+
+    return parse_location(location_snapshot=location_snapshot)
+
+
+@accounted
+def get_location_snapshot(location_id: str):
+    """location document alone, without its chargers or queued users"""
+    replica = read_replica()
+    if replica is not None:
+        location_snapshot = replica.location(location_id)
+        if location_snapshot is not None:
+            return location_snapshot
+
+    locations = stream(client().collection(u'location').where(u'location_id', u'==', location_id))
 
     if len(locations) == 0:
         logger.error(f'location {location_id} not found')
@@ -152,28 +738,61 @@ def get_location(location_id: str) -> Optional[Location]:
         logger.critical(f"location {location_id}'s found")
         return None
 
-    return parse_location(location_snapshot=locations[0])
+    return locations[0]
 
 
-def parse_location(location_ref=None, location_snapshot=None) -> Location:
+@accounted
+def parse_location(location_ref=None, location_snapshot=None, charger_snapshots=None, users: dict = None) -> Location:
     if location_ref is None and location_snapshot is None:
         raise ValueError('no location object supplied')
 
     if location_ref is None:
         location_ref = location_snapshot.reference
 
+    uow = current_unit_of_work()
+    if uow is not None and uow.get(location_ref.path) is not None:
+        return uow.get(location_ref.path)
+
     if location_snapshot is None:
-        location_snapshot = location_ref.get()
+        location_snapshot = read(location_ref)
 
     location_dict = location_snapshot.to_dict()
 
-    return Location(location_id=location_dict.get('location_id'),
-                    db_ref=location_ref,
-                    chargers=[parse_charger(charger_snapshot=i) for i in location_ref.collection('charger').stream()],
-                    queue=[parse_user(user_ref=i) for i in location_dict.get('queue')],
-                    reset_queue_daily=location_dict.get('reset_queue_daily', False))
+    if charger_snapshots is None:
+        replica = read_replica()
+        if replica is not None:
+            charger_snapshots = replica.location_chargers(location_ref.path)
+        else:
+            charger_snapshots = stream(location_ref.collection(u'charger'))
+
+    queue_refs = location_dict.get('queue', [])
+    if users is None:
+        users = get_users_by_ref(queue_refs)
+
+    location = Location(location_id=location_dict.get('location_id'),
+                        db_ref=location_ref,
+                        chargers=[parse_charger(charger_snapshot=i) for i in charger_snapshots],
+                        queue=[users[i.path] for i in queue_refs if i.path in users],
+                        reset_queue_daily=location_dict.get('reset_queue_daily', False))
+
+    return register_identity(location_ref, 'location', location.location_id, location)
+
+
+def location_manifest(location_id: str) -> dict:
+    # LOCATION DATABASE ENTITY MANIFEST
+    return {
+        'location_id': location_id,
+        'queue': [],
+        'reset_queue_daily': False,
+
+        # summary projection
+        'charger_count': 0,
+        'free_chargers': 0,
+        'queue_length': 0
+    }
 
 
+@accounted
 def create_location(location_id: str) -> None:
 
     for char in illegal_characters:
@@ -182,35 +801,37 @@ def create_location(location_id: str) -> None:
 
     logger.debug(f'creating {location_id}')
 
-    location_collection = db.collection(u'location')
+    location_collection = client().collection(u'location')
 
     # check if location is already registered
-    current_locations = [i for i in location_collection.where(u'location_id', u'==', location_id).stream()]
+    current_locations = stream(location_collection.where(u'location_id', u'==', location_id))
     if len(current_locations) > 0:
         logger.error(f'location {location_id} already exists')
         raise FileExistsError('location already registered')
 
-    # LOCATION DATABASE ENTITY MANIFEST
-    location_info = {
-        'location_id': location_id,
-        'queue': [],
-        'reset_queue_daily': False
-    }
+    location_info = location_manifest(location_id)
 
-    location_collection.document().set(location_info)
+    write(location_collection.document(), location_info)
 
 
-def update_location(location_id: str, updates: dict):
-    logger.debug(f'updating {location_id}, {", ".join([f"{i} = {j}" for i, j in updates.items()])}')
+@accounted
+def create_locations(location_ids: list) -> List[dict]:
+    """create locations, checking only the submitted ids and writing in chunked batches, returns a result per
+    location id"""
+    logger.debug(f'creating {len(location_ids)} locations')
 
-    location = get_location(location_id)
+    location_collection = client().collection(u'location')
 
-    if location is not None:
-        location.db_ref.update(updates)
-    else:
-        logger.error('no location returned')
+    errors = screen_ids(location_ids, existing_values(location_collection, u'location_id', location_ids),
+                        'location')
+
+    create_documents([(location_collection.document(), location_manifest(i))
+                      for i, j in zip(location_ids, errors) if j is None])
+
+    return bulk_results('location_id', location_ids, errors, 'location')
 
 
+@accounted
 def delete_location(location_id: str) -> None:
     logger.debug(f'deleting {location_id}')
 
@@ -219,11 +840,61 @@ def delete_location(location_id: str) -> None:
     if location is not None:
         for charger in get_chargers(location_id):
             delete_charger(location_id, charger.charger_id)
-        location.db_ref.delete()
+        if current_unit_of_work() is not None:
+            current_unit_of_work().evict(location.db_ref.path)
+        delete_document(location.db_ref)
     else:
         logger.error('no location returned')
 
 
+@accounted
+@transactional
+def change_queue(transaction, location_ref, user_ref, join: bool, now: datetime) -> tuple:
+    """add or remove one user with an array transform and move the user in or out of the in_queue state, the
+    transaction retries on contention so concurrent joins and leaves are never lost
+
+    returns the committed queue length and the user's new state, score and score_last_updated
+    """
+    snapshots = {i.reference.path: i for i in read_all([location_ref, user_ref], transaction=transaction)}
+    location_snapshot, user_snapshot = snapshots[location_ref.path], snapshots[user_ref.path]
+    if not location_snapshot.exists:
+        raise FileNotFoundError(f'{location_ref.path} not found')
+    if not user_snapshot.exists:
+        raise FileNotFoundError(f'{user_ref.path} not found')
+
+    queue = location_snapshot.to_dict().get('queue', [])
+    queued = user_ref.path in [i.path for i in queue]
+
+    if join and queued:
+        raise KeyError(f'{user_ref.path} already queued at {location_ref.path}')
+    if not join and not queued:
+        raise KeyError(f'{user_ref.path} not queued at {location_ref.path}')
+
+    user_dict = user_snapshot.to_dict()
+    state = User.State.in_queue if join else User.State.inactive
+    score = scoring.score_at(user_dict.get('score'), User.State[user_dict.get('state')],
+                             user_dict.get('score_last_updated'), now)
+
+    updates = {
+        'queue': firestore.ArrayUnion([user_ref]) if join else firestore.ArrayRemove([user_ref]),
+        'queue_length': len(queue) + (1 if join else -1)
+    }
+    for db_ref, fields in versioned_updates(location_ref, updates):
+        transaction.update(db_ref, fields)
+    transaction.update(user_ref, {'state': state.name, 'score': score, 'score_last_updated': now})
+
+    return updates['queue_length'], state, score, now
+
+
+def join_queue(location_ref, user_ref) -> tuple:
+    return change_queue(client().transaction(), location_ref, user_ref, join=True, now=datetime.utcnow())
+
+
+def leave_queue(location_ref, user_ref) -> tuple:
+    return change_queue(client().transaction(), location_ref, user_ref, join=False, now=datetime.utcnow())
+
+
+@accounted
 def queue_user(location_id: str, user: User):
     logger.debug(f'queuing {user} at {location_id}')
 
@@ -236,8 +907,7 @@ def queue_user(location_id: str, user: User):
                 logger.error(f'{user} not inactive {location_id}')
                 raise SystemError('user not inactive')
 
-            location.queue = location.queue + [user]
-            user.state = User.State.in_queue
+            location.enqueue(user)
             location.tick_queue()
         else:
             logger.error(f'{user} already queued at {location_id}')
@@ -247,6 +917,7 @@ def queue_user(location_id: str, user: User):
         raise FileNotFoundError(f'{location_id} not found')
 
 
+@accounted
 def remove_user_from_queue(location_id: str, user: User):
     logger.debug(f'removing {user} from queue at {location_id}')
 
@@ -254,11 +925,7 @@ def remove_user_from_queue(location_id: str, user: User):
 
     if location is not None:
         if user in location.queue:
-            new_queue = location.queue
-            new_queue.remove(user)
-            location.queue = new_queue
-
-            user.state = User.State.inactive
+            location.dequeue(user)
         else:
             logger.error(f'{user} not queued at {location_id}')
             raise KeyError(f'{user} not queued at {location_id}')
@@ -267,22 +934,120 @@ def remove_user_from_queue(location_id: str, user: User):
         raise FileNotFoundError(f'{location_id} not found')
 
 
+@accounted
+@transactional
+def reset_queued_users(transaction, location_ref, user_paths: set, now: datetime) -> tuple:
+    """remove up to a batch of the given users still queued at a location and make them inactive, users who
+    joined since they were listed stay queued and those who already left are left alone
+
+    returns the documents written, the paths of the users removed and the queue length left
+    """
+    location_snapshot = read(location_ref, transaction=transaction)
+    if not location_snapshot.exists:
+        return 0, [], 0
+
+    queue = location_snapshot.to_dict().get('queue', [])
+    # firestore sends the location update as two writes, its plain fields and its array remove and version
+    # increment transforms, every user update is one
+    user_refs = [i for i in queue if i.path in user_paths][:unit_of_work_registry.batch_limit - 2]
+    if len(user_refs) == 0:
+        return 0, [], len(queue)
+
+    user_snapshots = [i for i in read_all(user_refs, transaction=transaction) if i.exists]
+    user_dicts = [i.to_dict() for i in user_snapshots]
+    scores = scoring.rescore([i.get('score') for i in user_dicts],
+                             [User.State[i.get('state')].value for i in user_dicts],
+                             [i.get('score_last_updated') or now for i in user_dicts],
+                             now)
+
+    updates = versioned_updates(location_ref, {'queue': firestore.ArrayRemove(user_refs),
+                                               'queue_length': len(queue) - len(user_refs)})
+    for user_snapshot, score in zip(user_snapshots, scores):
+        updates.append((user_snapshot.reference, {'state': User.State.inactive.name,
+                                                  'score': float(score),
+                                                  'score_last_updated': now}))
+
+    for db_ref, fields in updates:
+        transaction.update(db_ref, fields)
+
+    if staged_writes(transaction) > unit_of_work_registry.batch_limit:
+        raise SystemError(f'resetting {location_ref.path} stages {staged_writes(transaction)} writes, over the '
+                          f'{unit_of_work_registry.batch_limit} write commit limit')
+
+    return len(updates), [i.path for i in user_refs], len(queue) - len(user_refs)
+
+
+def reset_location_queue(location_snapshot, now: datetime) -> int:
+    """empty one location's queue and make its users inactive, without ticking the queue
+
+    the users listed in the snapshot are removed in transactions so a concurrent join or leave is neither
+    lost nor leaves a user marked queued outside any queue
+    """
+    user_paths = {i.path for i in location_snapshot.to_dict().get('queue', [])}
+
+    documents, queue_length = 0, 0
+    while len(user_paths) > 0:
+        written, removed, queue_length = reset_queued_users(client().transaction(), location_snapshot.reference,
+                                                            user_paths, now)
+        if written == 0:
+            break
+        documents += written
+        user_paths.difference_update(removed)
+
+    events.hub.publish(location_snapshot.get(u'location_id'), 'queue_reset', {'queue_length': queue_length})
+
+    return documents
+
+
+@accounted
+def reset_queues() -> dict:
+    """bulk daily reset of every location flagged reset_queue_daily, locations are reset concurrently"""
+    start = time.perf_counter()
+    now = datetime.utcnow()
+
+    locations = stream(client().collection(u'location').where(u'reset_queue_daily', u'==', True))
+
+    with ThreadPoolExecutor(max_workers=reset_workers) as executor:
+        documents = list(executor.map(lambda i: reset_location_queue(i, now), locations))
+
+    summary = {
+        'locations': len(locations),
+        'documents': sum(documents),
+        'seconds': time.perf_counter() - start
+    }
+    logger.info(f'reset {summary["locations"]} queues, {summary["documents"]} documents '
+                f'in {summary["seconds"]:.3f}s')
+
+    return summary
+
+
+@accounted
 def get_chargers(location_id: str) -> Optional[List[Charger]]:
 
     location = get_location(location_id)
-    return [parse_charger(charger_snapshot=i) for i in location.db_ref.collection(u'charger').stream()]
+    return [parse_charger(charger_snapshot=i) for i in stream(location.db_ref.collection(u'charger'))]
 
 
+@accounted
 def get_charger(location_id: str, charger_id: str) -> Optional[Charger]:
     logger.debug(f'retrieving {location_id}:{charger_id}')
 
+    charger = lookup_identity('charger', (location_id, charger_id))
+    if charger is not None:
+        return charger
+
     location = get_location(location_id)
 
     if location is None:
         logger.error(f'location {location_id} not found')
         return None
 
-    chargers = [i for i in location.db_ref.collection(u'charger').where(u'charger_id', u'==', charger_id).stream()]
+    # location hydration has registered its chargers
+    charger = lookup_identity('charger', (location_id, charger_id))
+    if charger is not None:
+        return charger
+
+    chargers = stream(location.db_ref.collection(u'charger').where(u'charger_id', u'==', charger_id))
 
     if len(chargers) == 0:
         logger.error(f'charger {location_id}:{charger_id} not found')
@@ -294,6 +1059,30 @@ def get_charger(location_id: str, charger_id: str) -> Optional[Charger]:
     return parse_charger(charger_snapshot=chargers[0])
 
 
+@accounted
+def get_charger_snapshot(location_id: str, charger_id: str):
+    """single charger document without loading its location"""
+    replica = read_replica()
+    if replica is not None:
+        charger_snapshot = replica.charger(location_id, charger_id)
+        if charger_snapshot is not None:
+            return charger_snapshot
+
+    chargers = stream(client().collection_group(u'charger')
+                        .where(u'location_id', u'==', location_id)
+                        .where(u'charger_id', u'==', charger_id))
+
+    if len(chargers) == 0:
+        logger.error(f'charger {location_id}:{charger_id} not found')
+        return None
+    if len(chargers) > 1:
+        logger.critical(f"{len(chargers)} {location_id}:{charger_id}'s found")
+        return None
+
+    return chargers[0]
+
+
+@accounted
 def parse_charger(charger_ref=None, charger_snapshot=None) -> Charger:
     if charger_ref is None and charger_snapshot is None:
         raise ValueError('no charger object supplied')
@@ -301,18 +1090,38 @@ def parse_charger(charger_ref=None, charger_snapshot=None) -> Charger:
     if charger_ref is None:
         charger_ref = charger_snapshot.reference
 
+    uow = current_unit_of_work()
+    if uow is not None and uow.get(charger_ref.path) is not None:
+        return uow.get(charger_ref.path)
+
     if charger_snapshot is None:
-        charger_snapshot = charger_ref.get()
+        charger_snapshot = read(charger_ref)
 
     charger_dict = charger_snapshot.to_dict()
 
-    return Charger(location_id=charger_dict.get('location_id'),
-                   charger_id=charger_dict.get('charger_id'),
-                   db_ref=charger_ref,
-                   active_session=charger_dict.get('active_session'),
-                   state=Charger.State[charger_dict.get('state')])
+    charger = Charger(location_id=charger_dict.get('location_id'),
+                      charger_id=charger_dict.get('charger_id'),
+                      db_ref=charger_ref,
+                      active_session=charger_dict.get('active_session'),
+                      active_session_ref=charger_dict.get('active_session_ref'),
+                      state=Charger.State[charger_dict.get('state')])
+
+    return register_identity(charger_ref, 'charger', (charger.location_id, charger.charger_id), charger)
 
 
+def charger_manifest(location_id: str, charger_id: str) -> dict:
+    # CHARGER DATABASE ENTITY MANIFEST
+    return {
+        'location_id': location_id,
+        'charger_id': charger_id,
+        'active_session': None,
+        'active_session_ref': None,
+        'last_session_id': 0,
+        'state': Charger.State.available.name
+    }
+
+
+@accounted
 def create_charger(location_id: str, charger_id: str) -> None:
 
     for char in illegal_characters:
@@ -328,37 +1137,46 @@ def create_charger(location_id: str, charger_id: str) -> None:
         charger_collection = location.db_ref.collection(u'charger')
 
         # check if charger is already registered
-        charger_stream = [i for i in charger_collection.where(u'charger_id', u'==', charger_id).stream()]
+        charger_stream = stream(charger_collection.where(u'charger_id', u'==', charger_id))
         if len(charger_stream) > 0:
             logger.error(f'charger {charger_id} already exists')
             raise FileExistsError('charger already registered')
 
-        # CHARGER DATABASE ENTITY MANIFEST
-        charger_info = {
-            'location_id': location_id,
-            'charger_id': charger_id,
-            'active_session': None,
-            'state': Charger.State.available.name
-        }
+        charger_info = charger_manifest(location_id, charger_id)
 
-        charger_collection.document().set(charger_info)
+        write(charger_collection.document(), charger_info)
+        update_document(location.db_ref, {'charger_count': firestore.Increment(1),
+                                          'free_chargers': firestore.Increment(1)})
 
     else:
         logger.error(f'location {location_id} not found')
         return None
 
 
-def update_charger(location_id: str, charger_id: str, updates: dict):
-    logger.debug(f'updating {location_id}:{charger_id}, {", ".join([f"{i} = {j}" for i, j in updates.items()])}')
+@accounted
+def create_chargers(location_id: str, charger_ids: list) -> Optional[List[dict]]:
+    """create chargers at a location, checking only the submitted ids and writing in chunked batches, returns
+    a result per charger id or None when the location is not found"""
+    logger.debug(f'creating {len(charger_ids)} chargers at {location_id}')
 
-    charger = get_charger(location_id, charger_id)
+    location_snapshot = get_location_snapshot(location_id)
+    if location_snapshot is None:
+        return None
 
-    if charger is not None:
-        charger.db_ref.update(updates)
-    else:
-        logger.error(f'{location_id}:{charger_id} not returned')
+    charger_collection = location_snapshot.reference.collection(u'charger')
+
+    errors = screen_ids(charger_ids, existing_values(charger_collection, u'charger_id', charger_ids), 'charger')
 
+    created = create_documents([(charger_collection.document(), charger_manifest(location_id, i))
+                                for i, j in zip(charger_ids, errors) if j is None])
+    if created > 0:
+        update_documents([(location_snapshot.reference, {'charger_count': firestore.Increment(created),
+                                                         'free_chargers': firestore.Increment(created)})])
 
+    return bulk_results('charger_id', charger_ids, errors, 'charger')
+
+
+@accounted
 def delete_charger(location_id: str, charger_id: str) -> None:
     logger.debug(f'deleting {location_id}:{charger_id}')
 
@@ -366,12 +1184,22 @@ def delete_charger(location_id: str, charger_id: str) -> None:
 
     if charger is not None:
         for session in get_sessions(location_id, charger_id):
-            session.db_ref.delete()
-        charger.db_ref.delete()
+            if current_unit_of_work() is not None:
+                current_unit_of_work().evict(session.db_ref.path)
+            delete_document(session.db_ref)
+        if current_unit_of_work() is not None:
+            current_unit_of_work().evict(charger.db_ref.path)
+        delete_document(charger.db_ref)
+
+        summary = {'charger_count': firestore.Increment(-1)}
+        if charger.active_session is None:
+            summary['free_chargers'] = firestore.Increment(-1)
+        update_document(charger.location_ref, summary)
     else:
         logger.error(f'{location_id}:{charger_id} not returned')
 
 
+@accounted
 def get_sessions(location_id: str, charger_id: str):
     logger.debug(f'retrieving sessions for {location_id}:{charger_id}')
 
@@ -380,20 +1208,76 @@ def get_sessions(location_id: str, charger_id: str):
         logger.error(f'charger {location_id}:{charger_id} not found')
         return None
 
-    sessions = [i for i in charger.db_ref.collection(u'session').stream()]
+    sessions = stream(charger.db_ref.collection(u'session'))
+    users = get_users_by_ref([i.to_dict().get('user') for i in sessions if i.to_dict().get('user') is not None])
+
+    return [parse_session(session_snapshot=i, users=users) for i in sessions]
+
+
+@accounted
+def get_session_page(location_id: str,
+                     charger_id: str,
+                     limit: int,
+                     start_after: int = None,
+                     start_time_from: datetime = None,
+                     start_time_to: datetime = None,
+                     expand_user: bool = False):
+    """one page of a charger's session history ordered by start time, returns sessions and the next cursor"""
+    logger.debug(f'retrieving {limit} sessions for {location_id}:{charger_id} after {start_after}')
+
+    charger = lookup_identity('charger', (location_id, charger_id))
+    if charger is not None:
+        charger_ref = charger.db_ref
+    else:
+        charger_snapshot = get_charger_snapshot(location_id, charger_id)
+        if charger_snapshot is None:
+            logger.error(f'charger {location_id}:{charger_id} not found')
+            raise FileNotFoundError('charger not found')
+        charger_ref = charger_snapshot.reference
+
+    session_collection = charger_ref.collection(u'session')
+    query = session_collection
+
+    if start_time_from is not None:
+        query = query.where(u'start_time', u'>=', start_time_from)
+    if start_time_to is not None:
+        query = query.where(u'start_time', u'<', start_time_to)
+
+    query = query.order_by(u'start_time')
+
+    if start_after is not None:
+        cursor = stream(session_collection.where(u'session_id', u'==', start_after).limit(1))
+        if len(cursor) == 0:
+            logger.error(f'session cursor {location_id}:{charger_id}:{start_after} not found')
+            raise KeyError(f'session {start_after} not found')
+        query = query.start_after(cursor[0])
+
+    # one extra document tells whether another page exists without a count
+    session_snapshots = stream(query.limit(limit + 1))
+    next_cursor = session_snapshots[limit - 1].to_dict().get('session_id') if len(session_snapshots) > limit else None
+    session_snapshots = session_snapshots[:limit]
 
-    return [parse_session(session_snapshot=i) for i in sessions]
+    users = get_users_by_ref([i.to_dict().get('user') for i in session_snapshots if i.to_dict().get('user') is not None]) \
+        if expand_user else {}
 
+    return [parse_session(session_snapshot=i, users=users, expand_user=expand_user) for i in session_snapshots], \
+        next_cursor
 
+
+@accounted
 def get_session(location_id: str, charger_id: str, session_id: int):
     logger.debug(f'retrieving {location_id}:{charger_id}:{session_id}')
 
+    session = lookup_identity('session', (location_id, charger_id, session_id))
+    if session is not None:
+        return session
+
     charger = get_charger(location_id, charger_id)
     if charger is None:
         logger.error(f'charger {location_id}:{charger_id} not found')
         return None
 
-    sessions = [i for i in charger.db_ref.collection(u'session').where(u'session_id', u'==', session_id).stream()]
+    sessions = stream(charger.db_ref.collection(u'session').where(u'session_id', u'==', session_id))
 
     if len(sessions) == 0:
         logger.error(f'session {location_id}:{charger_id}:{session_id} not found')
@@ -406,32 +1290,40 @@ def get_session(location_id: str, charger_id: str, session_id: int):
     return parse_session(session_snapshot=sessions[0])
 
 
-def get_active_session(location_id: str, charger_id: str) -> Optional[Session]:
+@accounted
+def get_active_session(location_id: str, charger_id: str, charger_snapshot=None) -> Optional[Session]:
 
     logger.debug(f'retrieving active session for {location_id}:{charger_id}')
 
-    charger = get_charger(location_id, charger_id)
-    if charger is None:
-        logger.error(f'charger {location_id}:{charger_id} not found')
-        return None
-
-    if charger.active_session is None:
-        logger.debug(f'no active session for {location_id}:{charger_id}')
-        return None
+    charger = lookup_identity('charger', (location_id, charger_id))
+    if charger is not None:
+        active_session, active_session_ref = charger.active_session, charger.active_session_ref
+    else:
+        # skip hydrating the location, only the charger document is needed
+        if charger_snapshot is None:
+            charger_snapshot = get_charger_snapshot(location_id, charger_id)
+        if charger_snapshot is None:
+            logger.error(f'charger {location_id}:{charger_id} not found')
+            return None
 
-    sessions = [i for i in get_sessions(location_id, charger_id) if i.session_id == charger.active_session]
+        charger_dict = charger_snapshot.to_dict()
+        active_session, active_session_ref = charger_dict.get('active_session'), charger_dict.get('active_session_ref')
 
-    if len(sessions) == 0:
-        logger.error(f'active session not found for {location_id}:{charger_id}')
+    if active_session is None:
+        logger.debug(f'no active session for {location_id}:{charger_id}')
         return None
 
-    if len(sessions) > 1:
-        logger.critical(f'multiple active sessions found for {location_id}:{charger_id}')
-        return None
+    if active_session_ref is not None:
+        session = parse_session(session_ref=active_session_ref)
+        if session is not None:
+            return session
+        logger.error(f'active session reference broken for {location_id}:{charger_id}')
 
-    return sessions[0]
+    # sessions started before chargers held a reference to them
+    return get_session(location_id, charger_id, active_session)
 
 
+@accounted
 def start_session(location_id: str, charger_id: str, user: User):
 
     logger.debug(f'starting session for {location_id}:{charger_id}')
@@ -449,72 +1341,137 @@ def start_session(location_id: str, charger_id: str, user: User):
         logger.error(f'{user} not queued or assigned {location_id}:{charger_id}')
         raise SystemError('user not queued or assigned')
 
-    session_id = get_new_session_id(location_id, charger_id)
-
-    charger.db_ref.collection('session').document().set({
-        'location_id': location_id,
-        'charger_id': charger_id,
-        'session_id': session_id,
-        'start_time': datetime.utcnow(),
-        'end_time': None,
-        'user': user.db_ref
-    })
-    charger.active_session = session_id
-    charger.state = Charger.State.pre_session
-    remove_user_from_queue(location_id, user)
-    user.state = User.State.assigned
+    # changes earlier in this request, such as ending the charger's last session, are written by the claim
+    pending = pending_updates([charger.db_ref, charger.location_ref, user.db_ref])
 
+    now = datetime.utcnow()
+    session_ref = charger.db_ref.collection(u'session').document()
+    session_id, queue_length, score = claim_charger(client().transaction(), charger.db_ref, user.db_ref,
+                                                    session_ref, {
+                                                        'location_id': location_id,
+                                                        'charger_id': charger_id,
+                                                        'start_time': now,
+                                                        'end_time': None,
+                                                        'user': user.db_ref,
+                                                        'username': user.username
+                                                    }, pending)
+    discard_updates(pending.keys())
 
-def get_new_session_id(location_id: str, charger_id: str):
-    sessions = get_sessions(location_id, charger_id)
+    charger.claimed(session_id, session_ref)
 
-    if sessions is None:
-        return None
-
-    if len(sessions) == 0:
-        return 1
-
-    max_value = max([i.session_id for i in sessions])
-
-    session_id = max_value + 1
-    while session_id in [i.session_id for i in sessions]:
-        session_id = session_id + 1
-
-    return session_id
-
-
-def parse_session(session_ref=None, session_snapshot=None) -> Session:
+    location = get_location(location_id)
+    if location is not None:
+        location.dequeued(user, queue_length)
+    user.transitioned(User.State.assigned, score, now)
+
+    events.hub.publish(location_id, 'assignment', {'charger_id': charger_id, 'username': user.username,
+                                                   'session_id': session_id})
+
+
+def next_session_id(transaction, charger_ref, charger_dict: dict) -> int:
+    last_session_id = charger_dict.get('last_session_id')
+    if last_session_id is None:
+        # chargers created before the counter existed, seed it from the newest session
+        newest = stream(charger_ref.collection(u'session')
+                                   .order_by(u'session_id', direction=firestore.Query.DESCENDING)
+                                   .limit(1), transaction=transaction)
+        last_session_id = newest[0].to_dict().get('session_id', 0) if len(newest) > 0 else 0
+
+    return last_session_id + 1
+
+
+@accounted
+@transactional
+def claim_charger(transaction, charger_ref, user_ref, session_ref, session_info: dict, pending: dict) -> tuple:
+    """create a session on a free charger for a queued user, taking the charger and the user off the queue
+    and moving the charger to pre_session and the user to assigned in the same transaction, so concurrent
+    allocations can neither share a charger nor assign a user twice
+
+    pending holds the caller's uncommitted updates to these documents, document path -> field updates, they
+    are checked against and written with the claim
+
+    raises FileExistsError when the charger is taken and KeyError when the user is no longer queued,
+    returns the session id, the queue length left and the user's score
+    """
+    location_ref = charger_ref.parent.parent
+    now = session_info['start_time']
+
+    snapshots = {i.reference.path: i for i in read_all([charger_ref, location_ref, user_ref],
+                                                        transaction=transaction)}
+    charger_dict = overlay(snapshots[charger_ref.path].to_dict(), pending.get(charger_ref.path, {}))
+    if charger_dict.get('active_session') is not None:
+        raise FileExistsError(f'session already running on {charger_ref.path}')
+
+    queue = snapshots[location_ref.path].to_dict().get('queue', [])
+    if user_ref.path not in [i.path for i in queue]:
+        raise KeyError(f'{user_ref.path} not queued at {location_ref.path}')
+
+    user_dict = overlay(snapshots[user_ref.path].to_dict(), pending.get(user_ref.path, {}))
+    score = scoring.score_at(user_dict.get('score'), User.State[user_dict.get('state')],
+                             user_dict.get('score_last_updated'), now)
+
+    session_id = next_session_id(transaction, charger_ref, charger_dict)
+
+    refs = {i.path: i for i in [charger_ref, location_ref, user_ref]}
+    merged = {i: dict(j) for i, j in pending.items()}
+    for db_ref, fields in versioned_updates(charger_ref, {'last_session_id': session_id,
+                                                          'active_session': session_id,
+                                                          'active_session_ref': session_ref,
+                                                          'state': Charger.State.pre_session.name}) + \
+            versioned_updates(location_ref, {'queue': firestore.ArrayRemove([user_ref]),
+                                             'queue_length': len(queue) - 1,
+                                             'free_chargers': firestore.Increment(-1)}) + \
+            [(user_ref, {'state': User.State.assigned.name, 'score': score, 'score_last_updated': now})]:
+        refs[db_ref.path] = db_ref
+        unit_of_work_registry.merge_updates(merged.setdefault(db_ref.path, {}), fields)
+
+    for path, fields in merged.items():
+        transaction.update(refs[path], fields)
+    transaction.create(session_ref, {**session_info, 'session_id': session_id})
+
+    return session_id, len(queue) - 1, score
+
+
+@accounted
+def parse_session(session_ref=None, session_snapshot=None, users: dict = None, expand_user: bool = True) -> Session:
     if session_ref is None and session_snapshot is None:
         raise ValueError('no charger object supplied')
 
     if session_ref is None:
         session_ref = session_snapshot.reference
 
-    if session_snapshot is None:
-        session_snapshot = session_ref.get()
+    uow = current_unit_of_work()
+    if uow is not None and uow.get(session_ref.path) is not None:
+        return uow.get(session_ref.path)
 
-    charger_dict = session_snapshot.to_dict()
+    if session_snapshot is None:
+        session_snapshot = read(session_ref)
 
-    return Session(location_id=charger_dict.get('location_id'),
-                   charger_id=charger_dict.get('charger_id'),
-                   session_id=charger_dict.get('session_id'),
-                   db_ref=session_ref,
-                   start_time=charger_dict.get('start_time'),
-                   end_time=charger_dict.get('end_time'),
-                   user=parse_user(charger_dict.get('user')))
+    if not session_snapshot.exists:
+        logger.error(f'session {session_ref.path} not found')
+        return None
 
+    charger_dict = session_snapshot.to_dict()
 
-def update_session(location_id: str, charger_id: str, updates: dict):
-    logger.debug(f'updating {location_id}:{charger_id} session, {", ".join([f"{i} = {j}" for i, j in updates.items()])}')
+    user_ref = charger_dict.get('user')
+    if users is None:
+        users = get_users_by_ref([user_ref] if user_ref is not None and expand_user else [])
 
-    session = get_active_session(location_id, charger_id)
+    session = Session(location_id=charger_dict.get('location_id'),
+                      charger_id=charger_dict.get('charger_id'),
+                      session_id=charger_dict.get('session_id'),
+                      db_ref=session_ref,
+                      start_time=charger_dict.get('start_time'),
+                      end_time=charger_dict.get('end_time'),
+                      user=users.get(user_ref.path) if user_ref is not None else None,
+                      user_ref=user_ref,
+                      username=charger_dict.get('username'))
 
-    if session is not None:
-        session.db_ref.update(updates)
-    else:
-        logger.error(f'{location_id}:{charger_id} session not returned')
+    return register_identity(session_ref, 'session', (session.location_id, session.charger_id, session.session_id),
+                             session)
 
 
+@accounted
 def end_session(location_id: str, charger_id: str):
     logger.debug(f'stopping {location_id}:{charger_id} session')
 
@@ -531,13 +1488,16 @@ def end_session(location_id: str, charger_id: str):
         raise FileNotFoundError('no session found')
 
 
+@accounted
 def delete_session(location_id: str, charger_id: str, session_id):
     logger.debug(f'deleting {location_id}:{charger_id} session')
 
     session = get_session(location_id, charger_id, session_id)
 
     if session is not None:
-        session.db_ref.delete()
+        if current_unit_of_work() is not None:
+            current_unit_of_work().evict(session.db_ref.path)
+        delete_document(session.db_ref)
     else:
         logger.error(f'session {location_id}:{charger_id}:{session_id} not found')
         raise FileNotFoundError('session not found')
@@ -0,0 +1,579 @@
+"""in-memory stand-in for the subset of google.cloud.firestore used by schedule.db.database
+
+documents live in process memory behind a single lock, so the same database functions can run locally
+at memory speed for load tests, benchmarks and simulations without GCP credentials
+"""
+import copy
+import functools
+import logging
+import random
+import string
+import threading
+from datetime import datetime, timezone
+from enum import Enum
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud import firestore
+
+logger = logging.getLogger(__name__)
+
+id_characters = string.ascii_letters + string.digits
+
+
+def normalise(value):
+    """mirror firestore's conversions on write, naive datetimes are utc"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+    if isinstance(value, dict):
+        return {i: normalise(j) for i, j in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalise(i) for i in value]
+    return value
+
+
+def sort_key(value):
+    """firestore's cross type value ordering"""
+    if value is None:
+        return 0, 0
+    if isinstance(value, bool):
+        return 1, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    if isinstance(value, datetime):
+        return 3, normalise(value)
+    if isinstance(value, str):
+        return 4, value
+    if isinstance(value, DocumentReference):
+        return 5, value.path
+    if isinstance(value, (list, tuple)):
+        return 6, [sort_key(i) for i in value]
+    return 7, str(value)
+
+
+def get_field(data: dict, field_path: str):
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(field_path)
+        data = data[part]
+    return data
+
+
+def apply_updates(data: dict, updates: dict, time: datetime) -> dict:
+    data = copy.deepcopy(data)
+
+    for field_path, value in updates.items():
+        parts = field_path.split('.')
+        container = data
+        for part in parts[:-1]:
+            container = container.setdefault(part, {})
+        field = parts[-1]
+
+        if value is firestore.DELETE_FIELD:
+            container.pop(field, None)
+        elif value is firestore.SERVER_TIMESTAMP:
+            container[field] = time
+        elif isinstance(value, firestore.ArrayUnion):
+            existing = list(container.get(field) or [])
+            container[field] = existing + [i for i in normalise(list(value.values)) if i not in existing]
+        elif isinstance(value, firestore.ArrayRemove):
+            removed = normalise(list(value.values))
+            container[field] = [i for i in (container.get(field) or []) if i not in removed]
+        elif isinstance(value, firestore.Increment):
+            existing = container.get(field)
+            container[field] = (existing if isinstance(existing, (int, float)) else 0) + value.value
+        else:
+            container[field] = normalise(copy.deepcopy(value))
+
+    return data
+
+
+class Document:
+    def __init__(self, data: dict, create_time: datetime, update_time: datetime):
+        self.data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, document: Document = None, field_paths=None):
+        self.reference = reference
+        self._data = document.data if document is not None else None
+        self._field_paths = field_paths
+
+        self.create_time = document.create_time if document is not None else None
+        self.update_time = document.update_time if document is not None else None
+        self.read_time = datetime.now(timezone.utc)
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+
+        if self._field_paths is None:
+            return copy.deepcopy(self._data)
+
+        projected = {}
+        for field_path in self._field_paths:
+            try:
+                projected[field_path] = copy.deepcopy(get_field(self._data, field_path))
+            except KeyError:
+                continue
+        return projected
+
+    def get(self, field_path: str):
+        return get_field(self.to_dict() or {}, field_path)
+
+
+class DocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f'<DocumentReference {self.path}>'
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, collection_id: str):
+        return CollectionReference(self._client, f'{self.path}/{collection_id}')
+
+    def get(self, field_paths=None, transaction=None) -> DocumentSnapshot:
+        return self._client.read(self, field_paths=field_paths)
+
+    def create(self, document_data: dict):
+        self._client.write([('create', self, document_data)])
+
+    def set(self, document_data: dict, merge: bool = False):
+        self._client.write([('set_merge' if merge else 'set', self, document_data)])
+
+    def update(self, field_updates: dict):
+        self._client.write([('update', self, field_updates)])
+
+    def delete(self):
+        self._client.write([('delete', self, None)])
+
+
+class Query:
+    def __init__(self, client, collection_path: str = None, collection_group: str = None,
+                 filters=(), orders=(), limit=None, cursor=None, projection=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._collection_group = collection_group
+
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **kwargs):
+        state = {
+            'collection_path': self._collection_path,
+            'collection_group': self._collection_group,
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'cursor': self._cursor,
+            'projection': self._projection
+        }
+        state.update(kwargs)
+        return Query(self._client, **state)
+
+    def where(self, field_path: str, op_string: str, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, normalise(value)),))
+
+    def order_by(self, field_path: str, direction: str = firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        return self._copy(cursor=document_fields)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def _matches(self, data: dict) -> bool:
+        for field_path, op_string, value in self._filters:
+            try:
+                field = get_field(data, field_path)
+            except KeyError:
+                return False
+
+            if op_string == '==':
+                if field != value:
+                    return False
+            elif op_string == 'in':
+                if field not in value:
+                    return False
+            elif op_string == 'array_contains':
+                if not isinstance(field, list) or value not in field:
+                    return False
+            elif op_string == 'array_contains_any':
+                if not isinstance(field, list) or not any(i in field for i in value):
+                    return False
+            else:
+                if field is None or value is None or sort_key(field)[0] != sort_key(value)[0]:
+                    return False
+                if op_string == '<' and not sort_key(field) < sort_key(value):
+                    return False
+                if op_string == '<=' and not sort_key(field) <= sort_key(value):
+                    return False
+                if op_string == '>' and not sort_key(field) > sort_key(value):
+                    return False
+                if op_string == '>=' and not sort_key(field) >= sort_key(value):
+                    return False
+
+        for field_path, _ in self._orders:
+            try:
+                get_field(data, field_path)
+            except KeyError:
+                return False
+
+        return True
+
+    def _position(self, path: str, data: dict) -> list:
+        return [sort_key(get_field(data, i)) for i, _ in self._orders] + [(4, path)]
+
+    def _ordered(self, documents: list) -> list:
+        documents = sorted(documents, key=lambda x: x[0])
+        for index, (field_path, direction) in reversed(list(enumerate(self._orders))):
+            documents = sorted(documents, key=lambda x: sort_key(get_field(x[1].data, field_path)),
+                               reverse=direction == firestore.Query.DESCENDING)
+        return documents
+
+    def _after_cursor(self, path: str, data: dict) -> bool:
+        if isinstance(self._cursor, DocumentSnapshot):
+            cursor = self._position(self._cursor.reference.path, self._cursor._data)
+        else:
+            cursor = [sort_key(normalise(self._cursor.get(i))) for i, _ in self._orders]
+
+        position = self._position(path, data)[:len(cursor)]
+
+        for (value, cursor_value), direction in zip(zip(position, cursor),
+                                                    [i for _, i in self._orders] + [firestore.Query.ASCENDING]):
+            if value == cursor_value:
+                continue
+            if direction == firestore.Query.DESCENDING:
+                return value < cursor_value
+            return value > cursor_value
+
+        return False
+
+    def _covers(self, path: str) -> bool:
+        """whether a write to the document at path can change this query's results"""
+        collection_path = path.rsplit('/', 1)[0]
+        if self._collection_group is not None:
+            return collection_path.rsplit('/', 1)[-1] == self._collection_group
+        return collection_path == self._collection_path
+
+    def _snapshots(self) -> list:
+        with self._client.lock:
+            if self._collection_group is not None:
+                documents = self._client.group_documents(self._collection_group)
+            else:
+                documents = self._client.collection_documents(self._collection_path)
+
+            documents = self._ordered([(i, j) for i, j in documents if self._matches(j.data)])
+
+            if self._cursor is not None:
+                documents = [(i, j) for i, j in documents if self._after_cursor(i, j.data)]
+
+            if self._limit is not None:
+                documents = documents[:self._limit]
+
+            return [DocumentSnapshot(DocumentReference(self._client, i), j, self._projection) for i, j in documents]
+
+    def stream(self, transaction=None):
+        snapshots = self._snapshots()
+
+        self._client.count('queries')
+        self._client.count('streamed', len(snapshots))
+        return iter(snapshots)
+
+    def get(self, transaction=None):
+        return self.stream(transaction=transaction)
+
+    def on_snapshot(self, callback):
+        """callback(documents, changes, read_time) now and after every write that touches the query"""
+        return Watch(self, callback)
+
+
+class ChangeType(Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class DocumentChange:
+    def __init__(self, change_type: ChangeType, document: DocumentSnapshot, old_index: int, new_index: int):
+        self.type = change_type
+        self.document = document
+        self.old_index = old_index
+        self.new_index = new_index
+
+
+class Watch:
+    """snapshot listener standing in for firestore's watch stream, callbacks run on the writing thread
+    once the write is applied, so the change feed is never behind"""
+
+    def __init__(self, query: Query, callback):
+        self._query = query
+        self._callback = callback
+        self._documents = None  # path -> (index, update time) as last delivered
+
+        self.is_active = True
+        with query._client.lock:
+            query._client.listeners.append(self)
+            self.notify(datetime.now(timezone.utc))
+
+    def unsubscribe(self):
+        with self._query._client.lock:
+            self.is_active = False
+            if self in self._query._client.listeners:
+                self._query._client.listeners.remove(self)
+
+    def notify(self, read_time: datetime):
+        snapshots = self._query._snapshots()
+        documents = {j.reference.path: (i, j.update_time) for i, j in enumerate(snapshots)}
+
+        changes = []
+        for path, (index, update_time) in documents.items():
+            if self._documents is None or path not in self._documents:
+                changes.append(DocumentChange(ChangeType.ADDED, snapshots[index], -1, index))
+            elif self._documents[path][1] != update_time:
+                changes.append(DocumentChange(ChangeType.MODIFIED, snapshots[index], self._documents[path][0], index))
+        for path, (index, _) in (self._documents or {}).items():
+            if path not in documents:
+                changes.append(DocumentChange(ChangeType.REMOVED, DocumentSnapshot(self._query._client.document(path)),
+                                              index, -1))
+
+        first = self._documents is None
+        self._documents = documents
+        if first or len(changes) > 0:
+            self._callback(snapshots, changes, read_time)
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path: str):
+        super().__init__(client, collection_path=path)
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        if '/' not in self.path:
+            return None
+        return DocumentReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def document(self, document_id: str = None) -> DocumentReference:
+        if document_id is None:
+            document_id = ''.join(random.choices(id_characters, k=20))
+        return DocumentReference(self._client, f'{self.path}/{document_id}')
+
+    def add(self, document_data: dict):
+        reference = self.document()
+        reference.create(document_data)
+        return datetime.now(timezone.utc), reference
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def create(self, reference, document_data: dict):
+        self._writes.append(('create', reference, document_data))
+
+    def set(self, reference, document_data: dict, merge: bool = False):
+        self._writes.append(('set_merge' if merge else 'set', reference, document_data))
+
+    def update(self, reference, field_updates: dict):
+        self._writes.append(('update', reference, field_updates))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._client.write(writes)
+        return writes
+
+
+class Transaction(WriteBatch):
+    """serialisable transaction, holds the client lock from first use until commit or rollback"""
+
+    def __init__(self, client):
+        super().__init__(client)
+        self.in_progress = False
+
+    def begin(self):
+        self._client.lock.acquire()
+        self.in_progress = True
+
+    def rollback(self):
+        self._writes = []
+        if self.in_progress:
+            self.in_progress = False
+            self._client.lock.release()
+
+    def commit(self):
+        try:
+            return super().commit()
+        finally:
+            if self.in_progress:
+                self.in_progress = False
+                self._client.lock.release()
+
+
+def transactional(func):
+    """memory counterpart of firestore.transactional"""
+    @functools.wraps(func)
+    def transactional_wrapper(transaction: Transaction, *args, **kwargs):
+        transaction.begin()
+        try:
+            result = func(transaction, *args, **kwargs)
+        except Exception:
+            transaction.rollback()
+            raise
+        transaction.commit()
+        return result
+
+    return transactional_wrapper
+
+
+class Client:
+    """thread safe in-memory document store with the firestore.Client interface"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._collections = {}  # collection path -> {document id -> Document}
+
+        self.stats = {'reads': 0, 'queries': 0, 'streamed': 0, 'writes': 0}
+
+        self.listeners = []  # active Watch objects
+
+    def collection(self, collection_id: str) -> CollectionReference:
+        return CollectionReference(self, collection_id)
+
+    def collection_group(self, collection_id: str) -> Query:
+        return Query(self, collection_group=collection_id)
+
+    def document(self, document_path: str) -> DocumentReference:
+        return DocumentReference(self, document_path)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs) -> Transaction:
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        return iter([self.read(i, field_paths=field_paths) for i in references])
+
+    def collections(self):
+        with self.lock:
+            return [CollectionReference(self, i) for i in self._collections if '/' not in i]
+
+    def count(self, operation: str, documents: int = 1):
+        with self.lock:
+            self.stats[operation] += documents
+
+    def reset_stats(self) -> dict:
+        with self.lock:
+            stats, self.stats = self.stats, {i: 0 for i in self.stats}
+            return stats
+
+    # storage
+
+    def collection_documents(self, collection_path: str) -> list:
+        return [(f'{collection_path}/{i}', j) for i, j in self._collections.get(collection_path, {}).items()]
+
+    def group_documents(self, collection_id: str) -> list:
+        return [(f'{path}/{i}', j)
+                for path, documents in self._collections.items() if path.rsplit('/', 1)[-1] == collection_id
+                for i, j in documents.items()]
+
+    def read(self, reference: DocumentReference, field_paths=None) -> DocumentSnapshot:
+        collection_path, document_id = reference.path.rsplit('/', 1)
+        with self.lock:
+            document = self._collections.get(collection_path, {}).get(document_id)
+            self.stats['reads'] += 1
+            return DocumentSnapshot(reference, document, field_paths)
+
+    def write(self, writes: list):
+        """apply a list of (operation, reference, data) atomically"""
+        with self.lock:
+            time = datetime.now(timezone.utc)
+            staged = {}
+
+            def current(path):
+                if path in staged:
+                    return staged[path]
+                collection_path, document_id = path.rsplit('/', 1)
+                return self._collections.get(collection_path, {}).get(document_id)
+
+            for operation, reference, data in writes:
+                existing = current(reference.path)
+
+                if operation == 'create':
+                    if existing is not None:
+                        raise AlreadyExists(f'{reference.path} already exists')
+                    staged[reference.path] = Document(apply_updates({}, data, time), time, time)
+                elif operation == 'set':
+                    staged[reference.path] = Document(apply_updates({}, data, time),
+                                                      existing.create_time if existing is not None else time, time)
+                elif operation == 'set_merge':
+                    staged[reference.path] = Document(apply_updates(existing.data if existing is not None else {},
+                                                                    data, time),
+                                                      existing.create_time if existing is not None else time, time)
+                elif operation == 'update':
+                    if existing is None:
+                        raise NotFound(f'{reference.path} not found')
+                    staged[reference.path] = Document(apply_updates(existing.data, data, time),
+                                                      existing.create_time, time)
+                elif operation == 'delete':
+                    staged[reference.path] = None
+
+            for path, document in staged.items():
+                collection_path, document_id = path.rsplit('/', 1)
+                if document is None:
+                    self._collections.get(collection_path, {}).pop(document_id, None)
+                else:
+                    self._collections.setdefault(collection_path, {})[document_id] = document
+
+            self.stats['writes'] += len(writes)
+
+            for listener in list(self.listeners):
+                if any(listener._query._covers(i) for i in staged):
+                    listener.notify(time)
+
@@ -0,0 +1,146 @@
+"""in-process replica of the location and charger collections kept current by snapshot listeners
+
+reads are served from it while every listener is connected, or disconnected for no longer than
+max_staleness seconds, and no listener's latest snapshot was applied more than max_lag seconds after its
+read time, otherwise callers fall back to reading the datastore directly
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+import schedule.metrics as metrics
+from schedule.db.timestamps import to_datetime
+
+logger = logging.getLogger(__name__)
+
+# seconds between attempts to restart disconnected listeners
+reconnect_interval = 5.0
+
+
+class Replica:
+    def __init__(self, client, max_staleness: float, max_lag: float):
+        self.client = client
+        self.max_staleness = max_staleness
+        self.max_lag = max_lag
+
+        self.lock = threading.Lock()
+        self.locations = {}  # location id -> snapshot
+        self.chargers = {}  # location document path -> {charger id -> snapshot}
+
+        self.watches = {}  # collection -> listener
+        self.synced = set()  # collections delivered at least once
+        self.read_times = {}  # collection -> read time of the latest snapshot applied
+        self.lags = {}  # collection -> seconds the latest snapshot trailed its read time
+        self.connected_at = None  # monotonic time every listener was last seen connected
+        self.reconnect_at = 0.0
+
+    def start(self):
+        self.watches['location'] = self.client.collection(u'location').on_snapshot(self.on_locations)
+        self.watches['charger'] = self.client.collection_group(u'charger').on_snapshot(self.on_chargers)
+        logger.info('location replica listening')
+
+    def stop(self):
+        for watch in self.watches.values():
+            watch.unsubscribe()
+        self.watches = {}
+
+    def on_locations(self, documents, changes, read_time):
+        locations = {i.to_dict().get('location_id'): i for i in documents}
+        with self.lock:
+            self.locations = locations
+            self.synced.add('location')
+        self.observe_lag('location', read_time)
+
+    def on_chargers(self, documents, changes, read_time):
+        chargers = {}
+        for charger_snapshot in documents:
+            chargers.setdefault(charger_snapshot.reference.parent.parent.path, {})[
+                charger_snapshot.to_dict().get('charger_id')] = charger_snapshot
+        with self.lock:
+            self.chargers = chargers
+            self.synced.add('charger')
+        self.observe_lag('charger', read_time)
+
+    def observe_lag(self, collection: str, read_time):
+        read_time = to_datetime(read_time)
+        if read_time is not None:
+            lag = max((datetime.now(timezone.utc) - read_time).total_seconds(), 0.0)
+            with self.lock:
+                self.read_times[collection] = read_time
+                self.lags[collection] = lag
+            metrics.replica_update_lag.observe(collection, value=lag)
+
+    def lag(self) -> float:
+        """seconds the slowest listener's latest snapshot trailed its read time"""
+        with self.lock:
+            return max(self.lags.values(), default=0.0)
+
+    def connected(self) -> bool:
+        return len(self.watches) > 0 and all(getattr(i, 'is_active', False) for i in self.watches.values())
+
+    def staleness(self) -> Optional[float]:
+        """seconds the replica may be behind the datastore, None before its first full delivery"""
+        if len(self.synced) < 2:
+            return None
+
+        now = time.monotonic()
+        if self.connected():
+            self.connected_at = now
+            return 0.0
+        if self.connected_at is None:
+            return None
+        return now - self.connected_at
+
+    def serving(self) -> bool:
+        staleness = self.staleness()
+        if staleness is not None:
+            metrics.replica_staleness.observe(value=staleness)
+
+        if staleness is not None and staleness <= self.max_staleness:
+            lag = self.lag()
+            if lag <= self.max_lag:
+                return True
+            logger.debug(f'location replica listener lagging by {lag:.3f}s, snapshots read at '
+                         f'{", ".join(f"{i} {j.isoformat()}" for i, j in self.read_times.items())}, '
+                         f'reading the datastore')
+
+        self.reconnect()
+        metrics.replica_reads.inc('fallback')
+        return False
+
+    def reconnect(self):
+        now = time.monotonic()
+        if self.connected() or now < self.reconnect_at:
+            return
+
+        self.reconnect_at = now + reconnect_interval
+        logger.warning('location replica listener disconnected, restarting')
+        try:
+            self.stop()
+            self.start()
+        except Exception as e:
+            logger.error(f'unable to restart location replica listeners, {e}')
+
+    def location(self, location_id: str):
+        with self.lock:
+            location_snapshot = self.locations.get(location_id)
+        metrics.replica_reads.inc('hit' if location_snapshot is not None else 'miss')
+        return location_snapshot
+
+    def all_locations(self) -> list:
+        with self.lock:
+            return list(self.locations.values())
+
+    def location_chargers(self, location_path: str) -> List:
+        with self.lock:
+            return list(self.chargers.get(location_path, {}).values())
+
+    def charger(self, location_id: str, charger_id: str):
+        with self.lock:
+            location_snapshot = self.locations.get(location_id)
+            charger_snapshot = self.chargers.get(location_snapshot.reference.path, {}).get(charger_id) \
+                if location_snapshot is not None else None
+        metrics.replica_reads.inc('hit' if charger_snapshot is not None else 'miss')
+        return charger_snapshot
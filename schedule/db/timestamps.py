@@ -0,0 +1,14 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+
+def to_datetime(value) -> Optional[datetime]:
+    """timezone aware datetime from a firestore timestamp, firestore returns protobuf timestamps and the memory
+    backend datetimes"""
+    if value is None:
+        return None
+    if hasattr(value, 'ToDatetime'):
+        value = value.ToDatetime()
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
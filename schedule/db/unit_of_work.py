@@ -0,0 +1,124 @@
+import logging
+import threading
+
+from google.cloud import firestore
+
+import schedule.db.accounting as accounting
+
+logger = logging.getLogger(__name__)
+
+# firestore rejects write batches over 500 operations
+batch_limit = 500
+
+local = threading.local()
+
+
+def merge_updates(pending: dict, updates: dict) -> dict:
+    """fold updates into pending field updates, increments to the same field add up rather than replace"""
+    for field, value in updates.items():
+        if isinstance(value, firestore.Increment) and field in pending:
+            previous = pending[field]
+            if isinstance(previous, firestore.Increment):
+                value = firestore.Increment(previous.value + value.value)
+            elif isinstance(previous, (int, float)):
+                value = previous + value.value
+        pending[field] = value
+
+    return pending
+
+
+class UnitOfWork:
+    """request or job scoped identity map with deferred, merged document updates"""
+
+    def __init__(self, client, read_only: bool = False):
+        self.client = client
+        self.read_only = read_only  # reads may be served from the location replica
+
+        self.identity_map = {}  # document path -> model
+        self.keys = {}  # (kind, natural key) -> document path
+
+        self.refs = {}  # document path -> document reference
+        self.updates = {}  # document path -> pending field updates
+        self.callbacks = []  # run once the updates are committed
+
+    def get(self, path: str):
+        return self.identity_map.get(path)
+
+    def lookup(self, kind: str, key):
+        path = self.keys.get((kind, key))
+        if path is not None:
+            return self.identity_map.get(path)
+
+    def register(self, path: str, kind: str, key, model):
+        self.identity_map[path] = model
+        self.keys[(kind, key)] = path
+        return model
+
+    def evict(self, path: str):
+        self.identity_map.pop(path, None)
+        self.updates.pop(path, None)
+        self.keys = {i: j for i, j in self.keys.items() if j != path}
+
+    def update(self, db_ref, updates: dict):
+        self.refs[db_ref.path] = db_ref
+        merge_updates(self.updates.setdefault(db_ref.path, {}), updates)
+
+    def pending(self, paths: list) -> dict:
+        """copies of the field updates waiting on the given documents, document path -> field updates"""
+        return {i: dict(self.updates[i]) for i in paths if len(self.updates.get(i, {})) > 0}
+
+    def discard(self, paths: list):
+        """drop pending updates the caller has written some other way"""
+        for path in paths:
+            self.updates.pop(path, None)
+
+    def after_commit(self, callback) -> None:
+        self.callbacks.append(callback)
+
+    def commit(self) -> int:
+        pending = [(self.refs[path], updates) for path, updates in self.updates.items() if len(updates) > 0]
+        self.updates = {}
+
+        # callbacks run only once every batch has committed
+        callbacks, self.callbacks = self.callbacks, []
+
+        for i in range(0, len(pending), batch_limit):
+            batch = self.client.batch()
+            for db_ref, updates in pending[i:i + batch_limit]:
+                batch.update(db_ref, updates)
+            batch.commit()
+            accounting.record(writes=len(pending[i:i + batch_limit]))
+
+        if len(pending) > 0:
+            logger.debug(f'committed {len(pending)} document updates')
+
+        for callback in callbacks:
+            callback()
+
+        return len(pending)
+
+    def rollback(self):
+        if len(self.updates) > 0:
+            logger.warning(f'discarding updates to {len(self.updates)} documents')
+        self.updates = {}
+        self.callbacks = []
+
+
+def current():
+    return getattr(local, 'unit_of_work', None)
+
+
+def begin(client, read_only: bool = False) -> UnitOfWork:
+    if current() is not None:
+        logger.warning('unit of work already active, discarding')
+        current().rollback()
+
+    local.unit_of_work = UnitOfWork(client, read_only)
+    return local.unit_of_work
+
+
+def end():
+    uow = current()
+    if uow is not None:
+        uow.rollback()
+    local.unit_of_work = None
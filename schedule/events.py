@@ -0,0 +1,132 @@
+"""in-process fan-out of location events to server-sent event streams
+
+events are published once the unit of work that caused them commits. each location keeps a short history
+so a reconnecting stream can resume from its last event id, ids carry an instance prefix so an id from
+another instance is recognised and the client told to reload instead
+"""
+import itertools
+import json
+import logging
+import queue
+import secrets
+import threading
+from collections import deque
+from typing import List, Optional
+
+import schedule.db.database as database
+
+logger = logging.getLogger(__name__)
+
+# events kept per location for resuming streams
+history_length = 256
+
+# events buffered per subscriber before it is considered stalled and dropped
+subscriber_buffer = 1024
+
+
+class Event:
+    def __init__(self, event_id: str, location_id: str, event_type: str, data: dict):
+        self.event_id = event_id
+        self.location_id = location_id
+        self.event_type = event_type
+        self.data = data
+
+    def to_sse(self) -> str:
+        return f'id: {self.event_id}\nevent: {self.event_type}\ndata: {json.dumps(self.data, default=str)}\n\n'
+
+
+class Subscription:
+    def __init__(self, hub, location_id: str, replay: List[Event], cursor: str):
+        self.hub = hub
+        self.location_id = location_id
+        self.replay = replay
+        self.cursor = cursor  # resumes after the events held when subscribing
+        self.queue = queue.Queue(maxsize=subscriber_buffer)
+        self.dropped = False
+
+    def get(self, timeout: float) -> Optional[Event]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Hub:
+    def __init__(self):
+        self.instance = secrets.token_hex(4)
+        self.sequence = itertools.count(1)
+
+        self.lock = threading.Lock()
+        self.history = {}  # location id -> deque of recent events
+        self.subscribers = {}  # location id -> subscriptions
+
+    def publish(self, location_id: str, event_type: str, data: dict) -> Event:
+        with self.lock:
+            event = Event(f'{self.instance}-{next(self.sequence)}', location_id, event_type, data)
+            self.history.setdefault(location_id, deque(maxlen=history_length)).append(event)
+            subscribers = list(self.subscribers.get(location_id, []))
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                logger.warning(f'dropping stalled event stream for {location_id}')
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+
+        return event
+
+    def subscribe(self, location_id: str, last_event_id: str = None) -> Subscription:
+        """events after last_event_id are replayed, or a reset event if they are no longer held"""
+        with self.lock:
+            subscription = Subscription(self, location_id, self.replay(location_id, last_event_id),
+                                        self.cursor(location_id))
+            self.subscribers.setdefault(location_id, []).append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.location_id, [])
+            if subscription in subscribers:
+                subscribers.remove(subscription)
+
+    def cursor(self, location_id: str) -> str:
+        """id of the newest event held for a location, or one that stands before any event yet held"""
+        history = self.history.get(location_id)
+        return history[-1].event_id if history else f'{self.instance}-0'
+
+    def replay(self, location_id: str, last_event_id: str = None) -> List[Event]:
+        if last_event_id is None:
+            return []
+
+        history = list(self.history.get(location_id, []))
+        if last_event_id == f'{self.instance}-0' and len(history) < history_length:
+            # taken while nothing was held, so everything held since is newer
+            return history
+
+        for index, event in enumerate(history):
+            if event.event_id == last_event_id:
+                return history[index + 1:]
+
+        # from another instance, before a restart, or aged out of the history, resume from the newest event
+        return [Event(self.cursor(location_id), location_id, 'reset', {'location_id': location_id})]
+
+
+hub = Hub()
+
+
+def publish(location_id: str, event_type: str, data: dict) -> None:
+    """publish once the active unit of work commits, for changes written through it
+
+    changes a transaction has already committed are published on the hub straight away
+    """
+    database.after_commit(lambda: hub.publish(location_id, event_type, data))
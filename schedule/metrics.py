@@ -0,0 +1,157 @@
+"""in-process metrics exposed in prometheus text format
+
+each thread records into its own shard so the request path never takes a lock, shards are summed on scrape
+"""
+import threading
+import time
+from contextlib import contextmanager
+from typing import List
+
+default_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+registry = []
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, description: str, labels: List[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+        registry.append(self)
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _label_string(self, values: tuple, extra: dict = None) -> str:
+        pairs = list(zip(self.labels, values)) + list((extra or {}).items())
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{i}="{str(j)}"' for i, j in pairs) + '}'
+
+    def _merged(self) -> dict:
+        with self._shards_lock:
+            shards = list(self._shards)
+
+        merged = {}
+        for shard in shards:
+            for labels, value in list(shard.items()):
+                merged[labels] = self._combine(merged.get(labels), value)
+        return merged
+
+    def _combine(self, total, value):
+        return value if total is None else total + value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for labels, value in sorted(self._merged().items()):
+            lines.append(f'{self.name}{self._label_string(labels)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """summed across threads, so suited to values moved with inc and dec"""
+    kind = 'gauge'
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: List[str] = (), buckets: List[float] = None):
+        super().__init__(name, description, labels)
+        self.buckets = list(buckets or default_buckets)
+
+    def observe(self, *labels, value: float):
+        shard = self._shard()
+        observations = shard.get(labels)
+        if observations is None:
+            # per bucket counts, then sum and count
+            observations = shard[labels] = [0] * (len(self.buckets) + 2)
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                observations[index] += 1
+                break
+        observations[-2] += value
+        observations[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - start)
+
+    def _combine(self, total, value):
+        return list(value) if total is None else [i + j for i, j in zip(total, value)]
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for labels, observations in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, observations):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._label_string(labels, {"le": bound})} {cumulative}')
+            lines.append(f'{self.name}_bucket{self._label_string(labels, {"le": "+Inf"})} {observations[-1]}')
+            lines.append(f'{self.name}_sum{self._label_string(labels)} {observations[-2]}')
+            lines.append(f'{self.name}_count{self._label_string(labels)} {observations[-1]}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+request_latency = Histogram('http_request_duration_seconds', 'request latency by endpoint', ['endpoint', 'method'])
+request_status = Counter('http_requests_total', 'responses by endpoint and status', ['endpoint', 'method', 'status'])
+requests_in_flight = Gauge('http_requests_in_flight', 'requests being handled by endpoint', ['endpoint'])
+
+datastore_latency = Histogram('datastore_call_duration_seconds',
+                              'schedule.db.database call latency, nested calls included', ['function'])
+notification_latency = Histogram('notification_send_duration_seconds', 'push notification batch send latency',
+                                 ['result'])
+notification_outbox_size = Gauge('notification_outbox_size', 'notifications waiting to be delivered')
+
+app_import_seconds = Gauge('app_import_seconds', 'time spent importing the app at cold start')
+client_init_seconds = Gauge('client_init_seconds', 'time spent creating each shared client', ['client'])
+
+replica_reads = Counter('replica_reads_total', 'location replica reads by hit, miss or fallback to the datastore',
+                        ['result'])
+replica_update_lag = Histogram('replica_update_lag_seconds', 'delay from a listener read to the replica applying it',
+                               ['collection'])
+replica_staleness = Histogram('replica_staleness_seconds', 'how far the replica may be behind when consulted')
+
+password_hash_latency = Histogram('password_hash_duration_seconds', 'password hashing and verification time by operation',
+                                  ['operation'])
+password_hash_wait = Histogram('password_hash_wait_seconds', 'time password operations spend queued for a worker',
+                               ['operation'])
+password_hash_queue = Gauge('password_hash_queue_depth', 'password operations queued or running')
+password_hash_rejected = Counter('password_hash_rejected_total', 'password operations refused with a full queue',
+                                 ['operation'])
@@ -1,11 +1,12 @@
-from google.cloud.firestore import DocumentReference
+from google.cloud.firestore import DocumentReference, Increment
 from typing import List
 from enum import Enum
-from datetime import datetime
 
 import schedule.db.database as database
+import schedule.events as events
 from schedule.model.user import User
 from schedule.model.session import Session
+from schedule.model.queue import UserQueue
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,6 +27,7 @@ class Charger:
 
                  state: State,
                  active_session: int = None,
+                 active_session_ref: DocumentReference = None,
                  active_session_obj: Session = None):
 
         self.location_id = location_id
@@ -35,6 +37,7 @@ class Charger:
         if active_session_obj is not None:
             active_session = active_session_obj.session_id
 
+        self.active_session_ref = active_session_ref
         self._active_session_obj = active_session_obj
         self._active_session = active_session
         self._state = state
@@ -57,9 +60,34 @@ class Charger:
 
     @active_session.setter
     def active_session(self, value: int):
-        database.update_charger(self.location_id, self.charger_id, {'active_session': value})
+        previous = self._active_session
+        self.active_session_obj = database.get_session(self.location_id, self.charger_id, value) \
+            if value is not None else None
+        self.active_session_ref = self.active_session_obj.db_ref if self.active_session_obj is not None else None
+
+        database.update_document(self.db_ref, {'active_session': value, 'active_session_ref': self.active_session_ref})
+        if (previous is None) != (value is None):
+            database.update_document(self.location_ref, {'free_chargers': Increment(1 if value is None else -1)})
         self._active_session = value
-        self.active_session_obj = database.get_session(self.location_id, self.charger_id, self.active_session)
+
+    def claimed(self, session_id: int, session_ref: DocumentReference):
+        """record a session the datastore has already claimed this charger for, the claim moves it to
+        pre_session"""
+        previous = self._state
+        self._active_session = session_id
+        self._active_session_obj = None
+        self.active_session_ref = session_ref
+        self._state = self.State.pre_session
+
+        # published with the unit of work so it follows the charger_state of a session ended in this request
+        if previous != self._state:
+            events.publish(self.location_id, 'charger_state', {'charger_id': self.charger_id,
+                                                                'state': self._state.name,
+                                                                'previous': previous.name})
+
+    @property
+    def location_ref(self) -> DocumentReference:
+        return self.db_ref.parent.parent
 
     @property
     def active_session_obj(self) -> Session:
@@ -78,10 +106,15 @@ class Charger:
     def state(self, value: State):
         if self.active_session is not None and self.active_session_obj is None:
             self.active_session_obj = database.get_active_session(self.location_id, self.charger_id)
+        previous = self._state
         self._update_state(value)
-        database.update_charger(self.location_id, self.charger_id, {'state': value.name})
+        database.update_document(self.db_ref, {'state': value.name})
         self._state = value
 
+        if previous != value:
+            events.publish(self.location_id, 'charger_state', {'charger_id': self.charger_id, 'state': value.name,
+                                                                'previous': previous.name})
+
     def _update_state(self, new_state: State):
         if self.state == new_state:
             return
@@ -129,7 +162,7 @@ class Location:
         self.chargers = chargers
         self.reset_queue_daily = reset_queue_daily
 
-        self._queue = queue
+        self._queue = UserQueue(queue)
 
     def __str__(self):
         return self.location_id
@@ -147,28 +180,46 @@ class Location:
         }
 
     @property
-    def queue(self) -> List[User]:
+    def queue(self) -> UserQueue:
         return self._queue
 
-    @queue.setter
-    def queue(self, value: List[User]):
-        self.tick_queue()
-        database.update_location(self.location_id, {'queue': [i.db_ref for i in value]})
-        self._queue = value
+    # joins and leaves are committed straight away as their own transaction rather than with the unit of
+    # work, the array transform only carries the one user so the write does not grow with the queue
+
+    def enqueue(self, user: User):
+        """queue an inactive user, the datastore moves the user to in_queue in the same transaction"""
+        queue_length, state, score, time = database.join_queue(self.db_ref, user.db_ref)
+        user.transitioned(state, score, time)
+        self._queue.push(user)
+        events.hub.publish(self.location_id, 'queue_join', {'username': user.username, 'queue_length': queue_length})
+
+    def dequeue(self, user: User):
+        """take a user off the queue, the datastore makes the user inactive in the same transaction"""
+        queue_length, state, score, time = database.leave_queue(self.db_ref, user.db_ref)
+        self.dequeued(user, queue_length)
+        user.transitioned(state, score, time)
+
+    def dequeued(self, user: User, queue_length: int):
+        """forget a user already taken off the queue in the datastore"""
+        self._queue.remove(user)
+        events.hub.publish(self.location_id, 'queue_leave', {'username': user.username, 'queue_length': queue_length})
+
+    def candidates(self, count: int) -> List[User]:
+        """best queued users for count free chargers"""
+        return self._queue.top(count)
 
     def tick_queue(self):
         if len(self.queue) == 0:
             return
 
-        time = datetime.now()
-        for user in self.queue:
-            user.update_score(time)
-
         inactive_chargers = [i for i in self.chargers if i.active_session is None]
 
         if len(inactive_chargers) > 0:
-            queue = sorted(self.queue.copy(), key=lambda x: x.score)
-            users = queue[:len(inactive_chargers)]
+            users = self.candidates(len(inactive_chargers))
 
             for user, charger in zip(users, inactive_chargers):
-                database.start_session(self.location_id, charger.charger_id, user)
+                try:
+                    database.start_session(self.location_id, charger.charger_id, user)
+                except (FileExistsError, KeyError) as e:
+                    # another tick took the charger or the user first
+                    logger.warning(f'skipping {user} on {charger}, {e}')
@@ -0,0 +1,104 @@
+import heapq
+import itertools
+from typing import List, Iterator
+
+from schedule.model.user import User
+import schedule.model.scoring as scoring
+
+
+class UserQueue:
+    """indexed binary min-heap of users ordered by scoring.priority_key
+
+    push and remove are O(log n), top(k) is O(k log k)
+    """
+
+    def __init__(self, users: List[User] = None):
+        self._heap = []  # [key, sequence, user]
+        self._index = {}  # username -> heap position
+        self._sequence = itertools.count()
+
+        for user in users or []:
+            entry = [scoring.priority_key(user), next(self._sequence), user]
+            self._index[user.username] = len(self._heap)
+            self._heap.append(entry)
+
+        for position in reversed(range(len(self._heap) // 2)):
+            self._sift_down(position)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self) -> Iterator[User]:
+        return iter(self.users())
+
+    def __contains__(self, user: User):
+        return isinstance(user, User) and user.username in self._index
+
+    def users(self) -> List[User]:
+        """queued users in the order they joined"""
+        return [i[2] for i in sorted(self._heap, key=lambda x: x[1])]
+
+    def push(self, user: User):
+        if user in self:
+            raise KeyError(f'{user} already queued')
+
+        self._index[user.username] = len(self._heap)
+        self._heap.append([scoring.priority_key(user), next(self._sequence), user])
+        self._sift_up(len(self._heap) - 1)
+
+    def remove(self, user: User) -> User:
+        position = self._index.pop(user.username)
+        last = self._heap.pop()
+
+        if position == len(self._heap):
+            return last[2]
+
+        removed = self._heap[position]
+        self._heap[position] = last
+        self._index[last[2].username] = position
+        self._sift_down(position)
+        self._sift_up(self._index[last[2].username])
+
+        return removed[2]
+
+    def top(self, k: int) -> List[User]:
+        """best k users without disturbing or sorting the heap"""
+        result = []
+        frontier = [(self._heap[0][0], self._heap[0][1], 0)] if len(self._heap) > 0 and k > 0 else []
+
+        while len(frontier) > 0 and len(result) < k:
+            _, _, position = heapq.heappop(frontier)
+            result.append(self._heap[position][2])
+
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self._heap):
+                    heapq.heappush(frontier, (self._heap[child][0], self._heap[child][1], child))
+
+        return result
+
+    def _swap(self, i: int, j: int):
+        self._heap[i], self._heap[j] = self._heap[j], self._heap[i]
+        self._index[self._heap[i][2].username] = i
+        self._index[self._heap[j][2].username] = j
+
+    def _sift_up(self, position: int):
+        while position > 0:
+            parent = (position - 1) // 2
+            if self._heap[position][:2] < self._heap[parent][:2]:
+                self._swap(position, parent)
+                position = parent
+            else:
+                return
+
+    def _sift_down(self, position: int):
+        while True:
+            smallest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self._heap) and self._heap[child][:2] < self._heap[smallest][:2]:
+                    smallest = child
+
+            if smallest == position:
+                return
+
+            self._swap(position, smallest)
+            position = smallest
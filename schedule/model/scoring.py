@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+from schedule.model.user import User, restingScore, ddtInactive, ddtIn_Queue, ddtConnected_Charging, ddtConnected_Full
+
+
+def timestamp(time: datetime) -> float:
+    # naive datetimes are written as utc
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def rescore(scores, states, last_updated, time: datetime) -> np.ndarray:
+    """apply the piecewise-linear rate model to a whole queue at once
+
+    scores: current scores, states: User.State values, last_updated: datetimes or epoch seconds
+    """
+    scores = np.asarray(scores, dtype=float)
+    states = np.asarray(states, dtype=int)
+    last_updated = np.asarray([timestamp(i) if isinstance(i, datetime) else i for i in last_updated], dtype=float)
+
+    elapsed = np.maximum(timestamp(time) - last_updated, 0.0)
+
+    towards_resting = np.where(scores > restingScore,
+                               np.maximum(scores - ddtInactive * elapsed, restingScore),
+                               np.minimum(scores + ddtInactive * elapsed, restingScore))
+
+    return np.select(
+        [
+            states == User.State.inactive.value,
+            states == User.State.in_queue.value,
+            states == User.State.assigned.value,
+            states == User.State.connected_charging.value,
+            states == User.State.connected_full.value
+        ],
+        [
+            towards_resting,
+            scores + ddtIn_Queue * elapsed,
+            scores,
+            np.maximum(scores - ddtConnected_Charging * elapsed, 0.0),
+            scores - ddtConnected_Full * elapsed
+        ],
+        default=scores)
+
+
+def score_at(score: float, state: User.State, last_updated: datetime, time: datetime) -> float:
+    """one user's score under the same rate model as rescore, in plain floats"""
+    elapsed = max(timestamp(time) - timestamp(last_updated), 0.0) if last_updated is not None else 0.0
+
+    if state == User.State.inactive:
+        if score > restingScore:
+            return max(score - ddtInactive * elapsed, restingScore)
+        return min(score + ddtInactive * elapsed, restingScore)
+    if state == User.State.in_queue:
+        return score + ddtIn_Queue * elapsed
+    if state == User.State.connected_charging:
+        return max(score - ddtConnected_Charging * elapsed, 0.0)
+    if state == User.State.connected_full:
+        return score - ddtConnected_Full * elapsed
+    return score
+
+
+def priority_key(user: User) -> float:
+    """time invariant queue ordering key, lowest key is allocated first
+
+    every queued user's score drifts at ddtIn_Queue, so score minus that drift stays constant and
+    orders users exactly as their scores would at any instant
+    """
+    if user.state == User.State.in_queue and user.score_last_updated is not None:
+        return ddtIn_Queue * timestamp(user.score_last_updated) - user.anchor_score
+
+    time = datetime.utcnow()
+    return ddtIn_Queue * timestamp(time) - user.score_at(time)
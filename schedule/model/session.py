@@ -14,7 +14,10 @@ class Session:
                  end_time: datetime,
                  user: User,
 
-                 db_ref: DocumentReference):
+                 db_ref: DocumentReference,
+
+                 user_ref: DocumentReference = None,
+                 username: str = None):
         self.location_id = location_id
         self.charger_id = charger_id
         self.session_id = session_id
@@ -22,20 +25,27 @@ class Session:
         self._start_time = start_time
         self._end_time = end_time
         self._user = user
+        self._user_ref = user_ref if user_ref is not None or user is None else user.db_ref
+        self._username = username
 
         self.db_ref = db_ref
 
-    def to_dict(self) -> dict:
-        return {
+    def to_dict(self, expand_user: bool = True) -> dict:
+        response = {
             'location_id': self.location_id,
             'charger_id': self.charger_id,
             'session_id': self.session_id,
 
             'start_time': self.start_time,
             'end_time': self.end_time,
-            'user': self.user.to_dict()
+            'username': self.username
         }
 
+        if expand_user:
+            response['user'] = self.user.to_dict() if self.user is not None else None
+
+        return response
+
     def __str__(self):
         return f'{self.location_id}:{self.charger_id}:{self.session_id}'
 
@@ -45,7 +55,7 @@ class Session:
 
     @start_time.setter
     def start_time(self, value: datetime):
-        database.update_session(self.location_id, self.charger_id, {'start_time': value})
+        database.update_document(self.db_ref, {'start_time': value})
         self._start_time = value
 
     @property
@@ -54,14 +64,25 @@ class Session:
 
     @end_time.setter
     def end_time(self, value: datetime):
-        database.update_session(self.location_id, self.charger_id, {'end_time': value})
+        database.update_document(self.db_ref, {'end_time': value})
         self._end_time = value
 
     @property
     def user(self):
+        # loaded on first access when the session was parsed without expanding its user
+        if self._user is None and self._user_ref is not None:
+            self._user = database.parse_user(user_ref=self._user_ref)
         return self._user
 
     @user.setter
     def user(self, value: User):
-        database.update_session(self.location_id, self.charger_id, {'user': value})
+        database.update_document(self.db_ref, {'user': value.db_ref, 'username': value.username})
         self._user = value
+        self._user_ref = value.db_ref
+        self._username = value.username
+
+    @property
+    def username(self):
+        if self._username is None and self._user is not None:
+            return self._user.username
+        return self._username
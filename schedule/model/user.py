@@ -1,16 +1,15 @@
 from google.cloud.firestore import DocumentReference
 import schedule.db.database as db
+import schedule.notifications as notifications
+import schedule.passwords as passwords
+import schedule.model.scoring as scoring
 from enum import Enum
 from datetime import datetime
 
-from werkzeug.security import generate_password_hash, check_password_hash
 
 import logging
-import firebase_admin
-import firebase_admin.messaging as messaging
 
 logger = logging.getLogger(__name__)
-fire_admin = firebase_admin.initialize_app()
 
 restingScore = 500.0
 ddtInactive = 0.00694444444  # +/-25 per hour, tends towards restingScore (500)
@@ -75,28 +74,21 @@ class User:
     def __str__(self):
         return self.username
 
+    def _update(self, updates: dict):
+        db.update_document(self.db_ref, updates)
+
     def refresh_access_token(self):
         self.access_token = db.get_new_access_token()
 
     def send_notification(self, title: str, body: str):
+        """queued on the outbox once the state change commits, delivered in the background"""
 
         if self.notification_token is None:
             logger.error(f'{self.username} no notification token')
             return
 
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            android=messaging.AndroidConfig(
-                priority='high'
-            ),
-            token=self.notification_token
-        )
-
-        response = messaging.send(message)
-        logger.info(f'{response}')
+        notification = notifications.Notification(self.username, self.notification_token, title, body)
+        db.after_commit(lambda: notifications.outbox.enqueue(notification))
 
     @property
     def password(self):
@@ -104,12 +96,23 @@ class User:
 
     @password.setter
     def password(self, val: str):
-        pw_hash = generate_password_hash(val)
-        db.update_user(self.username, {'password': pw_hash})
+        pw_hash = passwords.hash_password(val)
+        self._update({'password': pw_hash})
         self._password = pw_hash
 
     def check_password(self, value: str) -> bool:
-        return check_password_hash(self.password, value)
+        if not passwords.check_password(self.password, value):
+            return False
+
+        # hashes made with an older cost are replaced while the plain password is at hand
+        if passwords.needs_rehash(self.password):
+            try:
+                self.password = value
+                logger.info(f'upgraded password hash for {self.username}')
+            except passwords.PasswordHashingBusy:
+                logger.warning(f'password hash upgrade for {self.username} deferred, hashing queue full')
+
+        return True
 
     @property
     def user_type(self):
@@ -117,17 +120,29 @@ class User:
 
     @user_type.setter
     def user_type(self, value: Type):
-        db.update_user(self.username, {'type': value.name})
+        self._update({'type': value.name})
         self._type = value
 
+    # score is stored as an anchor (score, score_last_updated, state) and evaluated on read,
+    # it is only written when the anchor moves on a state transition
+
     @property
     def score(self):
-        return self._score
+        return self.score_at(datetime.utcnow())
 
     @score.setter
     def score(self, value: float):
-        db.update_user(self.username, {'score': value})
+        time = datetime.utcnow()
+        self._update({'score': value, 'score_last_updated': time})
         self._score = value
+        self._score_last_updated = time
+
+    @property
+    def anchor_score(self):
+        return self._score
+
+    def score_at(self, time: datetime) -> float:
+        return scoring.score_at(self._score, self._state, self._score_last_updated, time)
 
     @property
     def state(self):
@@ -138,6 +153,26 @@ class User:
         if self.state == value:
             return
 
+        self._notify_state_change(value)
+
+        time = datetime.utcnow()
+        score = self.score_at(time)
+        self._update({'state': value.name, 'score': score, 'score_last_updated': time})
+
+        self._state = value
+        self._score = score
+        self._score_last_updated = time
+
+    def transitioned(self, value: State, score: float, time: datetime):
+        """record a state change the datastore has already committed"""
+        if self.state != value:
+            self._notify_state_change(value)
+
+        self._state = value
+        self._score = score
+        self._score_last_updated = time
+
+    def _notify_state_change(self, value: State):
         if self.state == self.State.inactive:
             if value == self.State.in_queue:
                 pass
@@ -174,16 +209,13 @@ class User:
             elif value in [self.State.in_queue, self.State.assigned, self.State.connected_charging]:
                 logger.warning(f'weird state change, {self.state.name} to {value.name}')
 
-        db.update_user(self.username, {'state': value.name})
-        self._state = value
-
     @property
     def score_last_updated(self):
         return self._score_last_updated
 
     @score_last_updated.setter
     def score_last_updated(self, value: datetime):
-        db.update_user(self.username, {'score_last_updated': value})
+        self._update({'score_last_updated': value})
         self._score_last_updated = value
 
     @property
@@ -191,8 +223,9 @@ class User:
         return self._access_token
 
     @access_token.setter
-    def access_token(self, value: float):
-        db.update_user(self.username, {'access_token': value})
+    def access_token(self, value: str):
+        db.invalidate_access_token(self._access_token)
+        self._update({'access_token': value})
         self._access_token = value
 
     @property
@@ -201,7 +234,7 @@ class User:
 
     @notification_token.setter
     def notification_token(self, value: float):
-        db.update_user(self.username, {'notification_token': value})
+        self._update({'notification_token': value})
         self._notification_token = value
 
     @property
@@ -210,34 +243,5 @@ class User:
 
     @access_token_last_refreshed.setter
     def access_token_last_refreshed(self, value: float):
-        db.update_user(self.username, {'access_token_last_refreshed': value})
+        self._update({'access_token_last_refreshed': value})
         self._access_token_last_refreshed = value
-
-    def update_score(self, time: datetime):
-        self.score_last_updated = time
-        time_diff = (time - self.score_last_updated).total_seconds()
-        # INACTIVE - score tends towards Resting Score (default 500) at +/-25 per hour.
-        if self.state == self.State.inactive:
-            if self.score > restingScore:
-                self.score = self.score - ddtInactive*time_diff
-                if self.score < restingScore:
-                    self.score = restingScore
-            if self.score < restingScore:
-                self.score = self.score + ddtInactive*time_diff
-                if self.score > restingScore:
-                    self.score = restingScore
-        # IN_QUEUE - score increases at +50 per hour
-        elif self.state == self.State.in_queue:
-            self.score = self.score + ddtIn_Queue*time_diff
-        # ASSIGNED - Score increases rapidly!
-        # The AssignedFixedPenalty is implemented in function assignedFixedPenalty.
-        elif self.state == self.State.assigned:
-            self.score = self.score
-        # CHARGING - score decreases at a rate of -75 per hour.
-        elif self.state == self.State.connected_charging:
-            self.score = self.score - ddtConnected_Charging*time_diff
-            if self.score < 0:
-                self.score = 0
-        # FULL - score decreases at a rate of -150 per hour.
-        elif self.state == self.State.connected_full:
-            self.score = self.score - ddtConnected_Full*time_diff
@@ -0,0 +1,169 @@
+"""push notification outbox
+
+state transitions enqueue notifications once their unit of work commits, a background worker sends them
+in fcm multicast batches and retries transient failures with exponential backoff
+"""
+import heapq
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from typing import List
+
+import firebase_admin.messaging as messaging
+
+import schedule.clients as clients
+import schedule.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# fcm accepts at most 500 messages per batch request
+batch_limit = 500
+
+# fcm error codes worth retrying, anything else means the message or token is bad
+retryable_codes = {'internal-error', 'server-unavailable', 'unknown-error', 'message-rate-exceeded',
+                   'device-message-rate-exceeded', 'topics-message-rate-exceeded'}
+
+
+class Notification:
+    def __init__(self, username: str, token: str, title: str, body: str):
+        self.username = username
+        self.token = token
+        self.title = title
+        self.body = body
+        self.attempts = 0
+
+    def message(self) -> messaging.Message:
+        return messaging.Message(
+            notification=messaging.Notification(
+                title=self.title,
+                body=self.body,
+            ),
+            android=messaging.AndroidConfig(
+                priority='high'
+            ),
+            token=self.token
+        )
+
+
+def send_all(messages: List[messaging.Message]) -> list:
+    """one fcm round trip for the batch, a response with success and exception per message"""
+    return messaging.send_all(messages, app=clients.firebase_app()).responses
+
+
+def retryable(exception) -> bool:
+    if not hasattr(exception, 'code'):
+        # raised for the whole batch, the request never got an answer
+        return True
+    return exception.code in retryable_codes
+
+
+class Outbox:
+    def __init__(self, send_batch=send_all, max_attempts: int = 5, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.send_batch = send_batch
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.queue = queue.Queue()
+        self.retries = []  # heap of (monotonic time due, sequence, notification), only touched by the worker
+        self.sequence = itertools.count()
+
+        self.pending = 0
+        self.pending_changed = threading.Condition()
+
+        self.worker = None
+        self.worker_lock = threading.Lock()
+
+    def enqueue(self, notification: Notification) -> None:
+        with self.pending_changed:
+            self.pending += 1
+        metrics.notification_outbox_size.inc()
+
+        self.queue.put(notification)
+        self.start()
+
+    def start(self) -> None:
+        if self.worker is not None and self.worker.is_alive():
+            return
+
+        with self.worker_lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name='notification-outbox', daemon=True)
+                self.worker.start()
+
+    def flush(self, timeout: float = None) -> bool:
+        """wait for every queued notification to be delivered or dropped"""
+        with self.pending_changed:
+            return self.pending_changed.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def run(self) -> None:
+        while True:
+            try:
+                batch = self.next_batch()
+                if len(batch) > 0:
+                    self.deliver(batch)
+            except Exception as e:
+                logger.exception(f'notification outbox worker error {e}')
+
+    def next_batch(self) -> List[Notification]:
+        batch = []
+
+        now = time.monotonic()
+        while len(self.retries) > 0 and self.retries[0][0] <= now and len(batch) < batch_limit:
+            batch.append(heapq.heappop(self.retries)[2])
+
+        if len(batch) == 0:
+            timeout = None if len(self.retries) == 0 else max(self.retries[0][0] - now, 0)
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                return batch
+
+        while len(batch) < batch_limit:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def deliver(self, batch: List[Notification]) -> None:
+        start, result = time.perf_counter(), 'error'
+        try:
+            responses = self.send_batch([i.message() for i in batch])
+            result = 'ok'
+        except Exception as e:
+            logger.error(f'notification batch of {len(batch)} failed, {e}')
+            responses = [e] * len(batch)
+        finally:
+            metrics.notification_latency.observe(result, value=time.perf_counter() - start)
+
+        done = 0
+        for notification, response in zip(batch, responses):
+            exception = response if isinstance(response, Exception) else response.exception
+            if exception is None:
+                logger.info(f'notified {notification.username}, {response.message_id}')
+                done += 1
+                continue
+
+            notification.attempts += 1
+            if retryable(exception) and notification.attempts < self.max_attempts:
+                delay = min(self.backoff * 2 ** (notification.attempts - 1), self.max_backoff)
+                delay *= random.uniform(0.5, 1.0)
+                heapq.heappush(self.retries, (time.monotonic() + delay, next(self.sequence), notification))
+            else:
+                logger.error(f'dropping notification for {notification.username} after '
+                             f'{notification.attempts} attempts, {exception}')
+                done += 1
+
+        if done > 0:
+            metrics.notification_outbox_size.dec(amount=done)
+            with self.pending_changed:
+                self.pending -= done
+                self.pending_changed.notify_all()
+
+
+outbox = Outbox()
@@ -0,0 +1,93 @@
+"""password hashing on a dedicated bounded pool
+
+pbkdf2 is deliberately slow, so hashing and verification run on a few worker threads instead of the request
+thread, and once the pool and its queue are full further requests are refused straight away rather than
+piling up behind each other and starving the rest of the api
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+import schedule.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# PASSWORD_HASH_ITERATIONS sets the pbkdf2 cost for new hashes, older hashes are upgraded on login
+iterations = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 150000))
+method = f'pbkdf2:sha256:{iterations}'
+
+workers = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+queue_depth = int(os.environ.get('PASSWORD_HASH_QUEUE_DEPTH', 32))
+
+executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+slots = threading.BoundedSemaphore(workers + queue_depth)
+
+# seconds bulk hashing waits for a free slot before giving up
+bulk_wait_seconds = 10.0
+
+
+class PasswordHashingBusy(RuntimeError):
+    pass
+
+
+def enqueue(operation: str, func, *args, timeout: float = None):
+    """queue func on the pool, waiting up to timeout for room, raises PasswordHashingBusy when there is none"""
+    acquired = slots.acquire(blocking=False) if timeout is None else slots.acquire(timeout=timeout)
+    if not acquired:
+        metrics.password_hash_rejected.inc(operation)
+        logger.warning(f'password hashing queue full, refusing {operation}')
+        raise PasswordHashingBusy('password hashing queue full')
+
+    metrics.password_hash_queue.inc()
+    queued = time.perf_counter()
+
+    def run():
+        metrics.password_hash_wait.observe(operation, value=time.perf_counter() - queued)
+        with metrics.password_hash_latency.time(operation):
+            return func(*args)
+
+    def release(future):
+        metrics.password_hash_queue.dec()
+        slots.release()
+
+    try:
+        future = executor.submit(run)
+    except Exception:
+        release(None)
+        raise
+    future.add_done_callback(release)
+    return future
+
+
+def submit(operation: str, func, *args):
+    """run func on the pool and wait for it"""
+    return enqueue(operation, func, *args).result()
+
+
+def hash_password(password: str) -> str:
+    return submit('hash', generate_password_hash, password, method)
+
+
+def hash_passwords(values: List[str]) -> List[str]:
+    """hash many passwords for provisioning, holding no more than one slot per worker so logins still get
+    through, and waiting for room rather than being refused"""
+    hashes = []
+    for index in range(0, len(values), workers):
+        futures = [enqueue('hash', generate_password_hash, i, method, timeout=bulk_wait_seconds)
+                   for i in values[index:index + workers]]
+        hashes.extend(i.result() for i in futures)
+    return hashes
+
+
+def check_password(password_hash: str, password: str) -> bool:
+    return submit('check', check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """hashed with a different method or cost than new hashes would be"""
+    return password_hash.split('$', 1)[0] != method
@@ -1,16 +1,115 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request, g
+import logging
 import os
+import time
 
-from .blueprint import auth_blueprint, location_blueprint, user_blueprint
+from .blueprint import auth_blueprint, location_blueprint, metrics_blueprint, user_blueprint
+import schedule.clients as clients
+import schedule.db.database as database
+import schedule.db.accounting as accounting
+import schedule.metrics as metrics
+import schedule.passwords as passwords
 
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), '..', 'build'), template_folder="templates")
 
+logger = logging.getLogger(__name__)
+
 api_prefix = '/api'
 app.register_blueprint(auth_blueprint, url_prefix=f'{api_prefix}/auth')
 app.register_blueprint(location_blueprint, url_prefix=f'{api_prefix}/location')
+app.register_blueprint(metrics_blueprint, url_prefix=f'{api_prefix}/metrics')
 app.register_blueprint(user_blueprint, url_prefix=f'{api_prefix}/user')
 
 
+# called by app engine before routing traffic to a new instance when app.yaml enables the warmup inbound service
+@app.route('/_ah/warmup')
+def warmup():
+    timings = clients.warm_up()
+    logger.info(f'warmed up {", ".join(f"{i} {j:.3f}s" for i, j in timings.items())}')
+    return jsonify({'clients': timings, 'status': 'ok'}), 200
+
+
+@app.before_request
+def begin_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.requests_in_flight.inc(str(request.endpoint))
+
+
+@app.before_request
+def begin_unit_of_work():
+    accounting.begin()
+    database.begin_unit_of_work(read_only=request.method in ['GET', 'HEAD'])
+
+
+# after_request functions run in reverse order, operations are reported once the unit of work commits
+@app.after_request
+def report_operations(response):
+    counts = accounting.current()
+    if counts is None:
+        return response
+
+    for operation, count in counts.to_dict().items():
+        response.headers[f'X-Datastore-{operation.replace("_", "-").title()}'] = str(count)
+
+    logger.info(f'{request.method} {request.path} datastore {counts}',
+                extra={'datastore': counts.to_dict(), 'datastore_calls': counts.calls})
+
+    over_budget = counts.over_budget(g.get('operation_budget', {}))
+    if len(over_budget) > 0:
+        message = f'{request.method} {request.path} over datastore budget, ' \
+                  f'{", ".join(f"{i} {j[0]} > {j[1]}" for i, j in over_budget.items())}'
+        if app.testing or os.environ.get('ENFORCE_OPERATION_BUDGETS'):
+            raise accounting.OperationBudgetExceeded(message)
+        logger.warning(message)
+
+    return response
+
+
+# flask sends the 500 for an unhandled exception through after_request too, so a request that failed part
+# way keeps none of its changes or after commit callbacks
+@app.after_request
+def commit_unit_of_work(response):
+    if response.status_code < 500:
+        database.commit_unit_of_work()
+    else:
+        database.rollback_unit_of_work()
+    return response
+
+
+@app.after_request
+def record_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_unit_of_work(exception=None):
+    database.end_unit_of_work()
+    accounting.end()
+
+
+@app.teardown_request
+def end_request_metrics(exception=None):
+    if 'request_start' not in g:
+        return
+
+    endpoint = str(request.endpoint)
+    status = g.get('response_status', 500) if exception is None else 500
+
+    metrics.request_latency.observe(endpoint, request.method, value=time.perf_counter() - g.request_start)
+    metrics.request_status.inc(endpoint, request.method, str(status))
+    metrics.requests_in_flight.dec(endpoint)
+
+
+# raised when logins outpace the password hashing pool, clients are asked to back off briefly
+@app.errorhandler(passwords.PasswordHashingBusy)
+def password_hashing_busy(e):
+    return jsonify({
+        'message': 'too many concurrent logins, retry shortly',
+        'status': 'error'
+    }), 503, {'Retry-After': '1'}
+
+
 @app.route('/')
 def root():
     return jsonify({
@@ -1,13 +1,11 @@
-from schedule.model.user import User
 import schedule.db.database as database
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
 
 def refresh_access_tokens(event, context):
-    users = database.get_users()
-    for user in [i for i in users if i.user_type != User.Type.service]:
-        user.refresh_access_token()
-
-    return 'ok'
+    # stop short of the function timeout so progress is saved, the next run resumes from there
+    time_limit = os.environ.get('TOKEN_ROTATION_TIME_LIMIT')
+    return database.rotate_access_tokens(time_limit=float(time_limit) if time_limit else None)
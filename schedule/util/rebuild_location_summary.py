@@ -0,0 +1,12 @@
+import schedule.db.database as database
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def rebuild_location_summary(event, context):
+    with database.unit_of_work():
+        updated = database.rebuild_location_summaries()
+
+    logger.info(f'rebuilt {updated} location summaries')
+    return 'ok'